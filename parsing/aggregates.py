@@ -0,0 +1,208 @@
+import logging
+import os
+from datetime import date
+from typing import List, Optional, Tuple
+
+import numpy as np
+from peewee import chunked, fn
+
+from aggregation import RAW_COLUMNS, AdColumns, daily_sums_to_series
+from constants import DAILY_AGGREGATES_PATH, DATA_TYPES, DEMOGRAPHICS, PARTIES
+from models import Ad, DirtyAd, database_handler
+from utils import time_range_len
+
+
+class DailyAggregateStore:
+    """
+    Persisted daily series of every party, data type and demographic.
+
+    The store also keeps the raw columns of every ad it aggregated. When an ad
+    is inserted or replaced (see DirtyAd), its old contribution is subtracted
+    and its new contribution is added, so a refresh only touches changed ads.
+    Ads without an end date are always recomputed, because their amount per day
+    depends on the current date. So are ads that were active after the last
+    date of the series, because their contribution was cut off at that date.
+    """
+
+    def __init__(
+        self,
+        first_date: date,
+        as_of: date,
+        counts: np.ndarray,
+        sums: np.ndarray,
+        ads: AdColumns,
+    ):
+        """
+        Create a store from its arrays.
+
+        :param first_date: The first date of the daily series.
+        :param as_of: The last date of the daily series.
+        :param counts: A (parties x dates) array with the number of active ads.
+        :param sums: A (parties x data types x demographics x dates) array.
+        :param ads: The ads that are aggregated in the store.
+        """
+        self.first_date = first_date
+        self.as_of = as_of
+        self.counts = counts
+        self.sums = sums
+        self.ads = ads
+
+    @classmethod
+    def build(
+        cls, first_date: date, today: date = date.today()
+    ) -> Tuple["DailyAggregateStore", Optional[int]]:
+        """
+        Create a store by aggregating all ads that were active since first_date.
+
+        :return: The store, and the id of the last DirtyAd that it includes (see DirtyAd.clear).
+        """
+        # The dirty ads and the ads are read in one transaction, so they are consistent.
+        with database_handler.atomic():
+            last_dirty_id = DirtyAd.select(fn.MAX(DirtyAd.id)).scalar()
+            ads = AdColumns.from_query(
+                Ad.ads_in_time_range(first_date=first_date, last_date=today),
+                first_date,
+                today,
+                today,
+            )
+
+        number_of_dates = time_range_len(first_date, today)
+        store = cls(
+            first_date,
+            today,
+            np.zeros((len(PARTIES), number_of_dates), dtype=np.int64),
+            np.zeros(
+                (len(PARTIES), len(DATA_TYPES), len(DEMOGRAPHICS), number_of_dates),
+                dtype=np.float64,
+            ),
+            ads,
+        )
+        store._apply(store.ads, 1)
+        return store, last_dirty_id
+
+    @classmethod
+    def load(cls, path: str = DAILY_AGGREGATES_PATH) -> Optional["DailyAggregateStore"]:
+        """Load a store from a file, or return None if it does not exist."""
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as store_file:
+            first_date = date.fromordinal(int(store_file["first_date"]))
+            as_of = date.fromordinal(int(store_file["as_of"]))
+            columns = {name: store_file[f"ads_{name}"] for name in RAW_COLUMNS}
+            columns["ad_ids"] = columns["ad_ids"].astype(object)
+            columns["parties"] = columns["parties"].astype(object)
+
+            return cls(
+                first_date,
+                as_of,
+                store_file["counts"],
+                store_file["sums"],
+                AdColumns(columns, first_date, as_of, today=as_of),
+            )
+
+    def save(self, path: str = DAILY_AGGREGATES_PATH) -> None:
+        """Save the store to a temporary file that replaces the file when it is complete."""
+        columns = self.ads.columns
+        columns["ad_ids"] = columns["ad_ids"].astype(str)
+        columns["parties"] = columns["parties"].astype(str)
+
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as h_store:
+            np.savez(
+                h_store,
+                first_date=self.first_date.toordinal(),
+                as_of=self.as_of.toordinal(),
+                counts=self.counts,
+                sums=self.sums,
+                **{f"ads_{name}": column for name, column in columns.items()},
+            )
+        os.replace(temporary_path, path)
+
+    def _apply(self, ads: AdColumns, sign: int) -> None:
+        """Add (sign=1) or subtract (sign=-1) the contribution of ads."""
+        for party_i, party in enumerate(PARTIES):
+            party_ads = ads.for_party(party)
+            if len(party_ads) == 0:
+                continue
+
+            for data_type_i, data_type in enumerate(DATA_TYPES):
+                counts, sums = party_ads.daily_sums(data_type, DEMOGRAPHICS)
+                self.sums[party_i, data_type_i] += sign * sums
+
+            self.counts[party_i] += sign * counts
+
+    def refresh(self, today: date = date.today()) -> Optional[int]:
+        """
+        Recompute the contributions of changed ads and extend the series up to today.
+
+        :return: The id of the last DirtyAd that was recomputed (see DirtyAd.clear).
+        """
+        as_of = self.as_of.toordinal()
+        time_range = Ad.ads_in_time_range(first_date=self.first_date, last_date=today)
+        recomputed = (
+            Ad.end_date.is_null()
+            | (Ad.end_date >= self.as_of)
+            | (Ad.start_date > self.as_of)
+        )
+
+        # The dirty ads and the ads are read in one transaction, so they are consistent.
+        with database_handler.atomic():
+            last_dirty_id = DirtyAd.select(fn.MAX(DirtyAd.id)).scalar()
+            dirty_ad_ids = [
+                ad_id
+                for ad_id, in DirtyAd.select(DirtyAd.ad_id)
+                .where(DirtyAd.id <= (last_dirty_id or 0))
+                .tuples()
+            ]
+
+            rows = list(Ad.analysis_view(time_range.where(recomputed)))
+            for ad_ids in chunked(dirty_ad_ids, 500):
+                rows += Ad.analysis_view(
+                    time_range.where(Ad.ad_id.in_(ad_ids) & ~recomputed)
+                )
+
+        stale = (
+            np.isin(self.ads.ad_ids, dirty_ad_ids)
+            | (self.ads.end_dates == 0)
+            | (self.ads.end_dates >= as_of)
+            | (self.ads.start_dates > as_of)
+        )
+        self._apply(self.ads.where(stale), -1)
+
+        number_of_dates = time_range_len(self.first_date, today)
+        padding = number_of_dates - self.counts.shape[-1]
+        self.counts = np.pad(self.counts, ((0, 0), (0, padding)))
+        self.sums = np.pad(self.sums, ((0, 0), (0, 0), (0, 0), (0, padding)))
+
+        changed_ads = AdColumns.from_rows(rows, self.first_date, today, today)
+        self._apply(changed_ads, 1)
+        logging.info(
+            f"Refreshed daily aggregates of {len(changed_ads)} ads "
+            f"(subtracted {stale.sum()} ads)."
+        )
+
+        kept_ads = self.ads.where(~stale).columns
+        self.ads = AdColumns(
+            {
+                name: np.concatenate([kept_ads[name], changed_ads.columns[name]])
+                for name in RAW_COLUMNS
+            },
+            self.first_date,
+            today,
+            today=today,
+        )
+        self.as_of = today
+        return last_dirty_id
+
+    def daily(self, party: str, data_type: str, demographics: List[str]) -> np.ndarray:
+        """Return the amount of a data type per demographic for every date, see AdColumns.daily."""
+        party_i = PARTIES.index(party)
+        return daily_sums_to_series(
+            self.counts[party_i],
+            self.sums[
+                party_i,
+                DATA_TYPES.index(data_type),
+                [DEMOGRAPHICS.index(d) for d in demographics],
+            ],
+        )
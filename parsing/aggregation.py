@@ -0,0 +1,299 @@
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from peewee import ModelSelect
+
+from constants import DEMOGRAPHICS, FIRST_DATE, UNCLASSIFIED_THEMES
+from models import DEMOGRAPHICS_STRUCT, Ad
+from utils import time_range_len
+
+# The columns of AdColumns.averages, in order.
+AVERAGED_DATA_TYPES = ["spending", "impressions", "estimated-audience-size"]
+
+# The columns that AdColumns is created from. Other columns are derived from these.
+RAW_COLUMNS = [
+    "ad_ids",
+    "parties",
+    "start_dates",
+    "end_dates",
+    "themes",
+    "spending_lower",
+    "spending_upper",
+    "averages",
+    "fractions",
+]
+
+
+def demographic_matrix(blobs: Sequence[Optional[bytes]]) -> np.ndarray:
+    """
+    Unpack values of Ad.demographics into a matrix, without creating a Python float for every fraction.
+
+    :param blobs: Values of Ad.demographics, which are None for ads without demographic data.
+    :return: An (ads x DEMOGRAPHICS[1:]) float32 matrix.
+    """
+    empty = bytes(DEMOGRAPHICS_STRUCT.size)
+    return np.frombuffer(
+        b"".join(blob or empty for blob in blobs), dtype=np.dtype("<f4")
+    ).reshape(len(blobs), len(DEMOGRAPHICS) - 1)
+
+
+class AdColumns:
+    """
+    Column arrays of a set of ads, used to aggregate ads without Python loops.
+
+    Every row in the arrays corresponds to one ad. Daily series are computed
+    over the days from first_date up to and including last_date.
+    """
+
+    def __init__(
+        self,
+        columns: Dict[str, np.ndarray],
+        first_date: date = FIRST_DATE,
+        last_date: date = date.today(),
+        today: Optional[date] = None,
+    ):
+        """
+        Create column arrays from raw columns.
+
+        :param columns: A dict with an array for every name in RAW_COLUMNS.
+        :param first_date: The first date of the daily series.
+        :param last_date: The last date of the daily series.
+        :param today: The end date of ads that are still active, defaults to today.
+        """
+        for name in RAW_COLUMNS:
+            setattr(self, name, columns[name])
+
+        self.first_date = first_date
+        self.last_date = last_date
+        self.number_of_dates = time_range_len(first_date, last_date)
+
+        today = (today or date.today()).toordinal()
+        start = self.start_dates
+        end = np.where(self.end_dates > 0, self.end_dates, today)
+        first = first_date.toordinal()
+        last = last_date.toordinal()
+
+        self.days_active = 1 + end - start
+
+        # See Ad.ads_in_time_range.
+        self.active = (start <= last) & (end >= first)
+        self.start_indices = np.maximum(start, first) - first
+        self.end_indices = np.minimum(end, last) - first
+
+    @classmethod
+    def from_rows(
+        cls,
+        rows: Iterable[tuple],
+        first_date: date = FIRST_DATE,
+        last_date: date = date.today(),
+        today: Optional[date] = None,
+    ) -> "AdColumns":
+        """Create column arrays from the tuples of Ad.analysis_view."""
+        rows = list(rows)
+        (
+            ad_ids,
+            parties,
+            start_dates,
+            end_dates,
+            themes,
+            spending_lower,
+            spending_upper,
+            impressions_lower,
+            impressions_upper,
+            audience_size_lower,
+            audience_size_upper,
+            demographics,
+        ) = (
+            zip(*rows) if rows else [()] * 12
+        )
+
+        bounds = np.array(
+            [
+                spending_lower,
+                spending_upper,
+                impressions_lower,
+                impressions_upper,
+                audience_size_lower,
+                audience_size_upper,
+            ],
+            dtype=np.int64,
+        )
+
+        # The first fractions column corresponds to the "total" demographic.
+        fractions = np.ones((len(rows), len(DEMOGRAPHICS)), dtype=np.float64)
+        fractions[:, 1:] = demographic_matrix(demographics)
+
+        themes = np.array(themes, dtype=np.int64)
+
+        columns = {
+            "ad_ids": np.array(ad_ids, dtype=object),
+            "parties": np.array(parties, dtype=object),
+            "start_dates": np.array(start_dates, dtype=np.int64),
+            # Ads that are still active have no end date, which is stored as 0.
+            "end_dates": np.array(end_dates, dtype=np.int64),
+            # Ads whose themes are not classified yet do not match any theme.
+            "themes": np.where(themes != UNCLASSIFIED_THEMES, themes, 0),
+            "spending_lower": bounds[0],
+            "spending_upper": bounds[1],
+            "averages": ((bounds[0::2] + bounds[1::2]) / 2).T.copy(),
+            "fractions": fractions,
+        }
+        return cls(columns, first_date, last_date, today)
+
+    @classmethod
+    def from_query(
+        cls,
+        query: ModelSelect,
+        first_date: date = FIRST_DATE,
+        last_date: date = date.today(),
+        today: Optional[date] = None,
+    ) -> "AdColumns":
+        """Load the ads of a query (e.g. Ad.ads_in_time_range) into column arrays."""
+        return cls.from_rows(Ad.analysis_view(query), first_date, last_date, today)
+
+    @property
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Return the raw columns, which can be used to recreate these column arrays."""
+        return {name: getattr(self, name) for name in RAW_COLUMNS}
+
+    def __len__(self) -> int:
+        """Return the number of ads."""
+        return len(self.ad_ids)
+
+    def where(self, mask: np.ndarray) -> "AdColumns":
+        """Return the subset of ads selected by a boolean mask."""
+        subset = object.__new__(AdColumns)
+        for key, value in self.__dict__.items():
+            subset.__dict__[key] = (
+                value[mask] if isinstance(value, np.ndarray) else value
+            )
+        return subset
+
+    def for_party(self, party: str) -> "AdColumns":
+        """Return the subset of ads of a party."""
+        return self.where(self.parties == party)
+
+    def for_theme(self, theme_value: int) -> "AdColumns":
+        """Return the subset of ads that match (all flags of) a theme."""
+        return self.where(self.themes & theme_value == theme_value)
+
+    def party_codes(self, parties: List[str]) -> np.ndarray:
+        """Return the index of the party of every ad in parties, or -1 if it is not in parties."""
+        party_indices = {party: i for i, party in enumerate(parties)}
+        return np.fromiter(
+            (party_indices.get(party, -1) for party in self.parties),
+            dtype=np.int64,
+            count=len(self),
+        )
+
+    def theme_matrix(self, theme_values: List[int]) -> np.ndarray:
+        """Return an (ads x themes) matrix that is 1 where an ad matches (all flags of) a theme, see for_theme."""
+        values = np.array(theme_values, dtype=np.int64)
+        return (self.themes[:, np.newaxis] & values == values).astype(np.float64)
+
+    def theme_totals(
+        self, data_type: str, theme_values: List[int], parties: List[str]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return the number of ads and the total amount of a data type of every theme.
+
+        The totals of all themes are the product of the theme matrix with the
+        (ads x DEMOGRAPHICS) matrix of amounts, so every ad is read once.
+
+        :param data_type: The data type.
+        :param theme_values: The values of the themes.
+        :param parties: The parties to also return the totals per party of.
+        :return: A (themes x DEMOGRAPHICS) array with the totals of all ads, a (parties x themes)
+        array with the number of ads and a (parties x themes x DEMOGRAPHICS) array with the totals.
+        """
+        # Sort the ads by party, so the ads of every party are a contiguous slice.
+        party_codes = self.party_codes(parties)
+        order = np.argsort(party_codes, kind="stable")
+        boundaries = np.searchsorted(party_codes[order], np.arange(len(parties) + 1))
+
+        themes = self.theme_matrix(theme_values)[order]
+        weights = self.weights(data_type, DEMOGRAPHICS)[order]
+
+        party_counts = np.zeros((len(parties), len(theme_values)), dtype=np.int64)
+        party_totals = np.zeros(
+            (len(parties), len(theme_values), len(DEMOGRAPHICS)), dtype=np.float64
+        )
+        for party_i, (start, end) in enumerate(zip(boundaries, boundaries[1:])):
+            party_counts[party_i] = themes[start:end].sum(axis=0)
+            party_totals[party_i] = themes[start:end].T @ weights[start:end]
+
+        return themes.T @ weights, party_counts, party_totals
+
+    def amounts(self, data_type: str, per_day: bool = False) -> np.ndarray:
+        """Return the amount of a data type for every ad, see Ad.rank_to_data."""
+        if data_type == "number-of-ads":
+            return np.ones(len(self), dtype=np.float64)
+
+        if data_type not in AVERAGED_DATA_TYPES:
+            raise ValueError(f"Unknown data type: {data_type}")
+
+        amounts = self.averages[:, AVERAGED_DATA_TYPES.index(data_type)]
+        if per_day:
+            return amounts / self.days_active
+
+        return amounts
+
+    def weights(
+        self, data_type: str, demographics: List[str], per_day: bool = False
+    ) -> np.ndarray:
+        """Return an (ads x demographics) matrix of the amount of a data type."""
+        amounts = self.amounts(data_type, per_day)[:, np.newaxis]
+        if data_type == "number-of-ads":
+            return np.repeat(amounts, len(demographics), axis=1)
+
+        indices = [DEMOGRAPHICS.index(d) for d in demographics]
+        return amounts * self.fractions[:, indices]
+
+    def totals(self, data_type: str, demographics: List[str]) -> np.ndarray:
+        """Return the total amount of a data type per demographic."""
+        return self.weights(data_type, demographics).sum(axis=0)
+
+    def daily_sums(
+        self, data_type: str, demographics: List[str]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the number of active ads and the amount of a data type for every date.
+
+        Every ad adds its amount per day to the first date it was active on and
+        subtracts it after the last date it was active on. The cumulative sum of
+        these differences is the amount on every date.
+
+        :return: An array with the number of active ads per date and a
+        (demographics x dates) array with the amounts per date.
+        """
+        weights = self.weights(data_type, demographics, per_day=True)[self.active]
+        start_indices = self.start_indices[self.active]
+        end_indices = self.end_indices[self.active] + 1
+        length = self.number_of_dates + 1
+
+        counts = np.cumsum(
+            np.bincount(start_indices, minlength=length)
+            - np.bincount(end_indices, minlength=length)
+        )[:-1]
+
+        sums = np.empty((len(demographics), self.number_of_dates), dtype=np.float64)
+        for demographic_i in range(len(demographics)):
+            differences = np.bincount(
+                start_indices, weights=weights[:, demographic_i], minlength=length
+            ) - np.bincount(
+                end_indices, weights=weights[:, demographic_i], minlength=length
+            )
+            sums[demographic_i] = np.cumsum(differences)[:-1]
+
+        return counts, sums
+
+    def daily(self, data_type: str, demographics: List[str]) -> np.ndarray:
+        """Return the amount of a data type per demographic for every date, as a (demographics x dates) array."""
+        return daily_sums_to_series(*self.daily_sums(data_type, demographics))
+
+
+def daily_sums_to_series(counts: np.ndarray, sums: np.ndarray) -> np.ndarray:
+    """Convert the output of AdColumns.daily_sums to daily series, which are zero on dates without ads."""
+    # Clip the rounding residue of subtracting amounts that ended.
+    return np.where(counts > 0, np.maximum(sums, 0), 0.0)
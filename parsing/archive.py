@@ -0,0 +1,73 @@
+import gzip
+import json
+import logging
+import os
+import threading
+from datetime import date
+from typing import Iterator, List, Optional
+
+from constants import RESPONSE_ARCHIVE_PATH
+
+# Serializes appends to the archive from the download threads.
+ARCHIVE_LOCK = threading.Lock()
+
+
+def shard_path(party: str, download_date: date = date.today()) -> str:
+    """Return the path of the shard that stores the ads of a party downloaded on a date."""
+    return os.path.join(
+        RESPONSE_ARCHIVE_PATH, download_date.isoformat(), f"{party}.jsonl.gz"
+    )
+
+
+def append_ads(party: str, ads: List[dict]) -> None:
+    """
+    Append raw ads from the Facebook API to the shard of a party.
+
+    Every call appends a separate gzip member, so a shard stays readable if a
+    download is interrupted.
+
+    :param party: The party the ads were requested for.
+    :param ads: Json objects representing ads from the Facebook API.
+    """
+    path = shard_path(party)
+    lines = "".join(json.dumps(ad, separators=(",", ":")) + "\n" for ad in ads)
+
+    with ARCHIVE_LOCK:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, "at", encoding="utf-8") as shard:
+            shard.write(lines)
+
+
+def shard_paths(parties: Optional[List[str]] = None) -> List[str]:
+    """
+    Return the paths of all shards in the archive, oldest first.
+
+    :param parties: If given, only return the shards of these parties.
+    """
+    if not os.path.exists(RESPONSE_ARCHIVE_PATH):
+        return []
+
+    paths = []
+    for download_date in sorted(os.listdir(RESPONSE_ARCHIVE_PATH)):
+        directory = os.path.join(RESPONSE_ARCHIVE_PATH, download_date)
+        for filename in sorted(os.listdir(directory)):
+            if parties is None or shard_party(filename) in parties:
+                paths.append(os.path.join(directory, filename))
+
+    return paths
+
+
+def shard_party(path: str) -> str:
+    """Return the party of a shard."""
+    return os.path.basename(path).removesuffix(".jsonl.gz")
+
+
+def read_ads(path: str) -> Iterator[dict]:
+    """Yield the raw ads in a shard, in the order they were downloaded."""
+    with gzip.open(path, "rt", encoding="utf-8") as shard:
+        try:
+            for line in shard:
+                yield json.loads(line)
+        except (EOFError, json.JSONDecodeError):
+            # The last member is incomplete if an append was interrupted.
+            logging.warning(f"Skipping the truncated end of {path}.")
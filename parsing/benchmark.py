@@ -0,0 +1,1118 @@
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from functools import cache
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+from peewee import SqliteDatabase, chunked
+from unidecode import unidecode
+
+from aggregation import AdColumns, demographic_matrix
+from archive import read_ads, shard_paths
+from constants import (
+    AD_LIMIT_PER_REQUEST,
+    AGE_RANGES,
+    DATABASE_PRAGMAS,
+    DATETIME_FORMAT,
+    DATA_TYPES,
+    DEMOGRAPHICS,
+    GENDERS,
+    INSERT_BATCH_SIZE,
+    NLP_BATCH_SIZE,
+    NLP_MODEL,
+    PARTIES,
+    REGIONS,
+    SIMILARITY_BATCH_SIZE,
+    STREAM_CHUNK_SIZE,
+    THEME_SIMILARITY_THRESHOLD,
+)
+from classify import classify_ads_by_similarity, rescore_ads
+from cube import Cube
+from models import MODELS, Ad, AdLemma, AdTheme, DirtyAd
+from parsing import (
+    AdStream,
+    ad_content,
+    doc_to_lemmas,
+    json_to_ad_dict,
+    lemmas_to_themes,
+    nlp,
+)
+from processing import (
+    PARTY_DAILY_SCHEMA,
+    SEPT_1,
+    create_general_data,
+    create_party_data,
+    create_theme_data,
+    load_ads,
+    render_general_pages,
+    render_party_page,
+    render_themes_page,
+)
+from similarity import ThemeCentroids
+from themes import Theme, ThemeMatcher
+from utils import encode_series
+
+if TYPE_CHECKING:
+    from spacy.vectors import Vectors
+
+logging.basicConfig(
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# Common Dutch words that do not occur in any wordlist.
+FILLER_WORDS = [
+    "vandaag",
+    "morgen",
+    "stem",
+    "verkiezing",
+    "kandidaat",
+    "lijst",
+    "campagne",
+    "gemeente",
+    "mensen",
+    "toekomst",
+    "samen",
+    "nieuw",
+    "goed",
+    "sterk",
+    "eerlijk",
+    "nederland",
+    "provincie",
+    "buurt",
+    "kiezer",
+    "idee",
+]
+
+# The number of ads that synthetic_archive generates at once.
+SYNTHETIC_ARCHIVE_SLICE_SIZE = 10000
+
+# The modules used by every script, whose cold start import is measured.
+IMPORT_TIME_MODULES = ["constants", "models", "parsing", "themes", "utils"]
+
+# Every run of a benchmark is appended to this file as a JSON object.
+BENCHMARK_HISTORY_PATH = "../data/benchmark_history.jsonl"
+# A timing that is this many times slower than the last run of a benchmark with the same size is a regression.
+REGRESSION_FACTOR = 1.25
+
+BENCHMARKS: Dict[str, Callable[[int], Dict[str, float]]] = {}
+
+
+def benchmark(name: str) -> Callable:
+    """Register a benchmark function, which is given a size and returns its results."""
+
+    def register(function: Callable[[int], Dict[str, float]]) -> Callable:
+        BENCHMARKS[name] = function
+        return function
+
+    return register
+
+
+def seconds_per_item(function: Callable, items: Sequence, repeat: int = 3) -> float:
+    """Return the fastest time it took to call a function on every item, divided by the number of items."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings) / len(items)
+
+
+def git_commit() -> Optional[str]:
+    """Return the commit that is checked out, or None if it is unknown."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(path: str) -> List[dict]:
+    """Return the runs in a history file, oldest first."""
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as h_history:
+        return [json.loads(line) for line in h_history if line.strip()]
+
+
+def append_history(path: str, run: dict) -> None:
+    """Append a run of a benchmark to a history file."""
+    with open(path, "a") as h_history:
+        h_history.write(json.dumps(run) + "\n")
+
+
+def regressions(previous_results: dict, results: dict) -> List[str]:
+    """
+    Compare the results of a benchmark with a previous run.
+
+    Timings (keys with "seconds") should not increase, rates (keys that end
+    with "per-second") should not decrease, by more than REGRESSION_FACTOR.
+
+    :return: A description of every result that regressed.
+    """
+    messages = []
+    for key, value in results.items():
+        previous_value = previous_results.get(key)
+        if not previous_value:
+            continue
+
+        if "seconds" in key and value > previous_value * REGRESSION_FACTOR:
+            messages.append(f"{key} increased from {previous_value:.3g} to {value:.3g}")
+        elif key.endswith("per-second") and value < previous_value / REGRESSION_FACTOR:
+            messages.append(f"{key} decreased from {previous_value:.3g} to {value:.3g}")
+
+    return messages
+
+
+@cache
+def _theme_words() -> List[str]:
+    """Return the words in all wordlists."""
+    return [word for theme in Theme.all() for word in theme.wordlist]
+
+
+def synthetic_lemmas(size: int, words_per_ad: int = 60) -> List[List[str]]:
+    """Generate the lemmas of synthetic ads, of which roughly a quarter occur in a wordlist."""
+    theme_words = _theme_words()
+    return [
+        [
+            random.choice(theme_words)
+            if random.random() < 0.25
+            else random.choice(FILLER_WORDS)
+            for _ in range(random.randint(words_per_ad // 2, words_per_ad * 2))
+        ]
+        for _ in range(size)
+    ]
+
+
+def _random_distribution(demographics: List[str]) -> Dict[str, float]:
+    """Return random fractions of demographics that add up to 1."""
+    weights = [random.random() for _ in demographics]
+    return {d: w / sum(weights) for d, w in zip(demographics, weights)}
+
+
+def synthetic_vectors(dimensions: int = 300) -> "Vectors":
+    """Generate random word vectors of the words in the wordlists and the filler words."""
+    from spacy.vectors import Vectors
+
+    words = sorted(set(_theme_words() + FILLER_WORDS))
+    return Vectors(
+        data=np.random.default_rng().standard_normal(
+            (len(words), dimensions), dtype=np.float32
+        ),
+        keys=words,
+    )
+
+
+def synthetic_ad_dicts(size: int, first_id: int = 0) -> List[dict]:
+    """Generate dicts of synthetic ads that correspond with the Ad model (see json_to_ad_dict)."""
+    ad_dicts = []
+    for i in range(first_id, first_id + size):
+        start_date = date(2020, 6, 1) + timedelta(days=random.randrange(1200))
+        spending_lower = random.choice([0, 100, 500, 1000, 5000])
+        impressions_lower = random.choice([0, 1000, 5000, 10000, 50000])
+        audience_size_lower = random.choice([0, 1000, 10000, 100000])
+
+        ad_dict = {
+            "ad_id": str(10**15 + i),
+            "page_id": str(random.randrange(10**14, 10**15)),
+            "party": random.choice(PARTIES),
+            "themes": random.choice([t.value for t in Theme]),
+            "creation_date": start_date,
+            "start_date": start_date,
+            "end_date": start_date + timedelta(days=random.randrange(60))
+            if random.random() < 0.95
+            else None,
+            "creative_bodies": " ".join(synthetic_lemmas(1, 20)[0]),
+            "creative_link_captions": "",
+            "creative_link_descriptions": "",
+            "creative_link_titles": "",
+            "spending_lower": spending_lower,
+            "spending_upper": spending_lower + 99,
+            "impressions_lower": impressions_lower,
+            "impressions_upper": impressions_lower + 999,
+            "audience_size_lower": audience_size_lower,
+            "audience_size_upper": audience_size_lower * 2,
+        }
+
+        # Most, but not all, ads have demographic data.
+        if random.random() < 0.8:
+            fractions = (
+                _random_distribution(GENDERS)
+                | _random_distribution(AGE_RANGES)
+                | _random_distribution(REGIONS)
+            )
+            ad_dict["demographics"] = Ad.pack_demographics(
+                [fractions[d] for d in DEMOGRAPHICS[1:]]
+            )
+        else:
+            ad_dict["demographics"] = None
+
+        ad_dicts.append(ad_dict)
+
+    return ad_dicts
+
+
+@contextmanager
+def synthetic_archive(size: int) -> Iterator[SqliteDatabase]:
+    """Create a temporary archive with synthetic ads, and bind the models to it."""
+    with tempfile.TemporaryDirectory() as directory:
+        database = SqliteDatabase(
+            os.path.join(directory, "archive.sqlite"), pragmas=DATABASE_PRAGMAS
+        )
+        with database.bind_ctx(MODELS):
+            database.create_tables(MODELS)
+
+            # Generate the ads in slices, so they are never all in memory.
+            for first_id in range(0, size, SYNTHETIC_ARCHIVE_SLICE_SIZE):
+                ad_dicts = synthetic_ad_dicts(
+                    min(SYNTHETIC_ARCHIVE_SLICE_SIZE, size - first_id), first_id
+                )
+                with database.atomic():
+                    for page in chunked(ad_dicts, AD_LIMIT_PER_REQUEST):
+                        Ad.insert_many(page).execute()
+
+            yield database
+
+        database.close()
+
+
+@contextmanager
+def synthetic_website() -> Iterator[str]:
+    """
+    Render pages into a temporary website directory instead of the real website.
+
+    The working directory is changed to a parsing directory next to it, so the
+    relative paths of the rendered pages and chart data resolve to the temporary
+    directory. The templates are linked from the repo.
+    """
+    templates_path = os.path.abspath("../templates")
+    working_directory = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "parsing"))
+        os.makedirs(os.path.join(directory, "website"))
+        os.symlink(templates_path, os.path.join(directory, "templates"))
+
+        os.chdir(os.path.join(directory, "parsing"))
+        try:
+            yield directory
+        finally:
+            os.chdir(working_directory)
+
+
+def synthetic_api_ads(size: int, first_id: int = 0) -> List[dict]:
+    """Generate synthetic ads in the format of the Facebook Ad Library API (see json_to_ad_dict)."""
+    api_ads = []
+    for i, ad_dict in enumerate(synthetic_ad_dicts(size, first_id)):
+        api_ad = {
+            "id": ad_dict["ad_id"],
+            "page_id": ad_dict["page_id"],
+            "ad_creation_time": ad_dict["creation_date"].isoformat(),
+            "ad_delivery_start_time": ad_dict["start_date"].isoformat(),
+            "ad_creative_bodies": [ad_dict["creative_bodies"]],
+            "ad_creative_link_titles": [" ".join(synthetic_lemmas(1, 4)[0])],
+            "currency": "EUR",
+            "languages": ["nl"],
+            "spend": {
+                "lower_bound": str(ad_dict["spending_lower"]),
+                "upper_bound": str(ad_dict["spending_upper"]),
+            },
+            "impressions": {
+                "lower_bound": str(ad_dict["impressions_lower"]),
+                "upper_bound": str(ad_dict["impressions_upper"]),
+            },
+            "estimated_audience_size": {
+                "lower_bound": ad_dict["audience_size_lower"],
+                "upper_bound": ad_dict["audience_size_upper"],
+            },
+        }
+        if ad_dict["end_date"] is not None:
+            api_ad["ad_delivery_stop_time"] = ad_dict["end_date"].isoformat()
+
+        if i % 5 != 0:
+            api_ad["delivery_by_region"] = [
+                {"region": region, "percentage": str(percentage)}
+                for region, percentage in _random_distribution(REGIONS).items()
+            ]
+            api_ad["demographic_distribution"] = [
+                {"gender": gender, "age": age, "percentage": str(random.random() / 14)}
+                for gender in GENDERS
+                for age in AGE_RANGES
+            ]
+
+        api_ads.append(api_ad)
+
+    return api_ads
+
+
+def recorded_api_ads(size: int) -> List[dict]:
+    """Return up to size ads from the response archive, or synthetic ads if the archive is empty."""
+    ads = []
+    for path in shard_paths():
+        for ad in read_ads(path):
+            if len(ads) == size:
+                return ads
+            ads.append(ad)
+
+    if len(ads) == 0:
+        logging.info("The response archive is empty, using synthetic ads.")
+        return synthetic_api_ads(size)
+
+    return ads
+
+
+def _decimal_demographics(ad_json_data: dict) -> Dict[str, Decimal]:
+    """Sum the demographics of an ad like json_to_ad_dict did before its lookup tables."""
+    demographics = {}
+    for distribution in ad_json_data.get("delivery_by_region", []):
+        region = distribution["region"]
+        if region == "North Brabant":
+            region = "Noord-Brabant"
+
+        if region in REGIONS:
+            field_name = Ad.demographic_to_field_name(region)
+            demographics[field_name] = Decimal(distribution["percentage"])
+
+    for distribution in ad_json_data.get("demographic_distribution", []):
+        percentage = Decimal(distribution["percentage"])
+        for demographic in (distribution["gender"], distribution["age"]):
+            if demographic in GENDERS or demographic in AGE_RANGES:
+                field_name = Ad.demographic_to_field_name(demographic)
+                demographics[field_name] = (
+                    demographics.get(field_name, Decimal(0)) + percentage
+                )
+
+    return demographics
+
+
+# The field names of the demographics in _decimal_demographics, in the order of Ad.demographics.
+DEMOGRAPHIC_FIELD_NAMES = [Ad.demographic_to_field_name(d) for d in DEMOGRAPHICS[1:]]
+
+
+def _strptime_dates(ad_json_data: dict) -> List[Optional[datetime]]:
+    """Parse the dates of an ad like json_to_ad_dict did before date.fromisoformat."""
+    return [
+        datetime.strptime(ad_json_data[key], DATETIME_FORMAT)
+        if key in ad_json_data
+        else None
+        for key in (
+            "ad_creation_time",
+            "ad_delivery_start_time",
+            "ad_delivery_stop_time",
+        )
+    ]
+
+
+def _list_scan_intersections(words: List[str]) -> Dict[Theme, int]:
+    """Count the common words like Theme.intersections did before ThemeMatcher."""
+    return {t: sum(1 for word in words if word in t.wordlist) for t in Theme.all()}
+
+
+def _recursive_round(o, precision: Optional[int] = None) -> None:
+    """Round the numbers in nested lists in place like utils.recursive_round did before DATA_TYPE_PRECISIONS."""
+    if isinstance(o, dict):
+        for key in o:
+            _recursive_round(o[key], 2 if "spend" in key else precision)
+    elif isinstance(o, list) and len(o) > 0 and isinstance(o[0], (list, dict)):
+        for object_element in o:
+            _recursive_round(object_element, precision)
+    elif isinstance(o, list) and len(o) > 0 and isinstance(o[0], (int, float)):
+        for object_index, object_element in enumerate(o):
+            o[object_index] = round(object_element, precision)
+
+
+def _list_encode_series(series: List[list], precision: Optional[int]) -> dict:
+    """Encode daily series like utils.encode_series did before it encoded arrays."""
+    scale = 10 ** (precision or 0)
+
+    deltas = []
+    for values in series:
+        scaled_values = [round(value * scale) for value in values]
+        deltas.append(
+            scaled_values[:1]
+            + [b - a for a, b in zip(scaled_values, scaled_values[1:])]
+        )
+
+    return {"scale": scale, "deltas": deltas}
+
+
+@benchmark("theme-matching")
+def benchmark_theme_matching(size: int) -> Dict[str, float]:
+    """Compare the cost per ad of scanning the wordlists with the ThemeMatcher index."""
+    corpus = synthetic_lemmas(size)
+
+    start = time.perf_counter()
+    matcher = ThemeMatcher(Theme.all())
+    build_seconds = time.perf_counter() - start
+
+    assert all(
+        matcher.intersections(words) == _list_scan_intersections(words)
+        for words in corpus[:100]
+    )
+
+    return {
+        "list-scan-seconds-per-ad": seconds_per_item(_list_scan_intersections, corpus),
+        "matcher-seconds-per-ad": seconds_per_item(matcher.intersections, corpus),
+        "matcher-build-seconds": build_seconds,
+    }
+
+
+@benchmark("bulk-insert")
+def benchmark_bulk_insert(size: int) -> Dict[str, float]:
+    """
+    Compare inserting pages of ads into an empty archive with and without tuning.
+
+    The untuned archive uses the default pragmas and commits every statement,
+    the tuned archive uses DATABASE_PRAGMAS and commits once per page (see download.write_ads).
+    """
+    ad_dicts = synthetic_ad_dicts(size)
+
+    results = {}
+    for name, pragmas, batched in [
+        ("untuned", {}, False),
+        ("tuned", DATABASE_PRAGMAS, True),
+    ]:
+        with tempfile.TemporaryDirectory() as directory:
+            database = SqliteDatabase(
+                os.path.join(directory, "archive.sqlite"), pragmas=pragmas
+            )
+            with database.bind_ctx(MODELS):
+                database.create_tables(MODELS)
+
+                start = time.perf_counter()
+                for page in chunked(ad_dicts, AD_LIMIT_PER_REQUEST):
+                    with database.atomic() if batched else nullcontext():
+                        Ad.insert_many(page).on_conflict_replace().execute()
+                        DirtyAd.mark(ad["ad_id"] for ad in page)
+                        AdTheme.set_themes({ad["ad_id"]: ad["themes"] for ad in page})
+
+                results[f"{name}-ads-per-second"] = size / (time.perf_counter() - start)
+            database.close()
+
+    return results
+
+
+@benchmark("ad-conversion")
+def benchmark_ad_conversion(size: int) -> Dict[str, float]:
+    """
+    Measure the cost per ad of json_to_ad_dict on recorded ads, and of the steps it used to take.
+
+    tests/test_parsing.py checks that json_to_ad_dict is faster than the steps it used to take.
+    """
+    ads = recorded_api_ads(size)
+    return {
+        "json-to-ad-dict-seconds-per-ad": seconds_per_item(
+            lambda ad: json_to_ad_dict(ad, "VVD"), ads
+        ),
+        "decimal-demographics-seconds-per-ad": seconds_per_item(
+            _decimal_demographics, ads
+        ),
+        "strptime-dates-seconds-per-ad": seconds_per_item(_strptime_dates, ads),
+    }
+
+
+@benchmark("streaming-ingest")
+def benchmark_streaming_ingest(size: int) -> Dict[str, float]:
+    """
+    Compare the peak memory and time of parsing a response at once and as a stream.
+
+    A single response with all ads is written to a file, which is read in chunks like
+    download.download_page does. Converted ads are discarded in batches of INSERT_BATCH_SIZE.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "response.json")
+        with open(path, "w") as response_file:
+            json.dump(
+                {"data": synthetic_api_ads(size), "paging": {"next": "https://next"}},
+                response_file,
+            )
+
+        def read_chunks() -> Iterator[bytes]:
+            with open(path, "rb") as response_file:
+                yield from iter(lambda: response_file.read(STREAM_CHUNK_SIZE), b"")
+
+        def parse_at_once() -> int:
+            response = json.loads(b"".join(read_chunks()))
+            ad_dicts = [json_to_ad_dict(ad, "VVD") for ad in response["data"]]
+            return len(ad_dicts)
+
+        def parse_stream() -> int:
+            ad_stream = AdStream(read_chunks())
+            number_of_ads = 0
+            for ad_dicts in chunked(
+                (json_to_ad_dict(ad, "VVD") for ad in ad_stream), INSERT_BATCH_SIZE
+            ):
+                number_of_ads += len(ad_dicts)
+
+            assert ad_stream.paging == {"next": "https://next"}
+            return number_of_ads
+
+        results = {"response-megabytes": os.path.getsize(path) / 2**20}
+        for name, parse in [("at-once", parse_at_once), ("stream", parse_stream)]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            assert parse() == size
+            results[f"{name}-seconds"] = time.perf_counter() - start
+            results[f"{name}-peak-megabytes"] = (
+                tracemalloc.get_traced_memory()[1] / 2**20
+            )
+            tracemalloc.stop()
+
+    return results
+
+
+@benchmark("demographic-storage")
+def benchmark_demographic_storage(size: int) -> Dict[str, float]:
+    """
+    Compare storing demographics in a float column per demographic (like older archives) with Ad.demographics.
+
+    Measures the size of the archive and the time it takes to read all demographics into a matrix.
+    """
+    blobs = [ad["demographics"] for ad in synthetic_ad_dicts(size)]
+    matrix = demographic_matrix(blobs)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, columns, rows in [
+            (
+                "columns",
+                [f"{field_name} REAL" for field_name in DEMOGRAPHIC_FIELD_NAMES],
+                matrix.astype(np.float64).tolist(),
+            ),
+            ("blob", ["demographics BLOB"], [(blob,) for blob in blobs]),
+        ]:
+            path = os.path.join(directory, f"{name}.sqlite")
+            database = SqliteDatabase(path)
+            database.execute_sql(
+                f"CREATE TABLE ad (id INTEGER PRIMARY KEY, {', '.join(columns)})"
+            )
+            with database.atomic():
+                database.cursor().executemany(
+                    f"INSERT INTO ad VALUES (NULL, {', '.join('?' * len(columns))})",
+                    rows,
+                )
+
+            start = time.perf_counter()
+            selected_rows = database.execute_sql(
+                f"SELECT {', '.join(c.split()[0] for c in columns)} FROM ad"
+            ).fetchall()
+            if name == "blob":
+                read_matrix = demographic_matrix([row[0] for row in selected_rows])
+            else:
+                read_matrix = np.array(selected_rows, dtype=np.float64)
+            results[f"{name}-read-seconds"] = time.perf_counter() - start
+
+            assert np.array_equal(read_matrix, matrix)
+            database.close()
+
+            results[f"{name}-megabytes"] = os.path.getsize(path) / 2**20
+
+    return results
+
+
+@benchmark("analysis-load")
+def benchmark_analysis_load(size: int) -> Dict[str, float]:
+    """
+    Compare loading ads as Ad instances with their amounts per day, and as AdColumns.
+
+    Measures the time it takes to load all ads in a synthetic archive (use a size of
+    at least 1M to be representative), and the memory that the loaded ads take.
+    """
+
+    def load_instances() -> list:
+        ads = list(Ad.ads_in_time_range())
+        for ad in ads:
+            ad.average_spending_per_day
+            ad.average_impressions_per_day
+            ad.average_audience_size_per_day
+
+        return ads
+
+    def load_columns() -> AdColumns:
+        return AdColumns.from_query(Ad.ads_in_time_range())
+
+    results = {}
+    with synthetic_archive(size):
+        for name, load in [("instances", load_instances), ("columns", load_columns)]:
+            start = time.perf_counter()
+            assert len(load()) == size
+            results[f"{name}-seconds"] = time.perf_counter() - start
+
+            tracemalloc.start()
+            ads = load()
+            results[f"{name}-megabytes"] = tracemalloc.get_traced_memory()[0] / 2**20
+            results[f"{name}-peak-megabytes"] = (
+                tracemalloc.get_traced_memory()[1] / 2**20
+            )
+            tracemalloc.stop()
+            del ads
+
+    return results
+
+
+@benchmark("page-serialization")
+def benchmark_page_serialization(size: int) -> Dict[str, float]:
+    """
+    Compare rounding and encoding the daily series of the party pages as nested lists and as arrays.
+
+    The lists are rounded in place and then encoded, like the pages were before
+    the daily series were kept as arrays. Aggregating the series is not measured.
+    """
+    with synthetic_archive(size):
+        ads = AdColumns.from_query(
+            Ad.ads_in_time_range(first_date=SEPT_1), first_date=SEPT_1
+        )
+    party_data = {p: create_party_data(p, ads.for_party(p)) for p in PARTIES}
+
+    def serialize_lists() -> List[bytes]:
+        contents = []
+        for data in party_data.values():
+            data = {
+                key: value.tolist() if isinstance(value, np.ndarray) else value
+                for key, value in data.items()
+            }
+            _recursive_round(data)
+            chart_data = {
+                key: _list_encode_series(data[key], 2 if "spend" in key else None)
+                for key in PARTY_DAILY_SCHEMA
+            }
+            contents.append(json.dumps(chart_data, separators=(",", ":")).encode())
+        return contents
+
+    def serialize_arrays() -> List[bytes]:
+        contents = []
+        for data in party_data.values():
+            chart_data = {
+                key: encode_series(data[key], precision)
+                for key, precision in PARTY_DAILY_SCHEMA.items()
+            }
+            contents.append(json.dumps(chart_data, separators=(",", ":")).encode())
+        return contents
+
+    results = {}
+    for name, serialize in [("lists", serialize_lists), ("arrays", serialize_arrays)]:
+        start = time.perf_counter()
+        contents = serialize()
+        results[f"{name}-seconds"] = time.perf_counter() - start
+        results[f"{name}-bytes"] = sum(len(content) for content in contents)
+
+    return results
+
+
+@benchmark("stages")
+def benchmark_stages(size: int) -> Dict[str, float]:
+    """
+    Time every stage of the pipeline separately, from API ads to rendered pages.
+
+    The ads are converted (json_to_ad_dict), parsed (nlp().pipe and doc_to_lemmas),
+    classified (lemmas_to_themes) and inserted (insert_many) in slices, like download.py
+    and classify.py do. If the spaCy model is not installed, the words of the synthetic
+    texts are used as their lemmas, and parse-skipped is 1 instead of parse-seconds.
+    Afterwards, the ads are loaded, aggregated and rendered like the processing
+    scripts do, into a temporary website directory.
+    """
+    results = {}
+
+    parse_texts = importlib.util.find_spec(NLP_MODEL) is not None
+    if parse_texts:
+        # The model is loaded once per run, which is not part of the time per slice.
+        nlp()
+    else:
+        logging.warning(
+            f"The spaCy model {NLP_MODEL} is not installed, parsing is skipped."
+        )
+        results["parse-skipped"] = 1.0
+
+    def timed(stage: str, function: Callable, *args):
+        start = time.perf_counter()
+        value = function(*args)
+        results[f"{stage}-seconds"] = (
+            results.get(f"{stage}-seconds", 0.0) + time.perf_counter() - start
+        )
+        return value
+
+    def parse(ad_dicts: List[dict]) -> List[List[str]]:
+        texts = (unidecode(ad_content(ad_dict)) for ad_dict in ad_dicts)
+        return [
+            doc_to_lemmas(doc) for doc in nlp().pipe(texts, batch_size=NLP_BATCH_SIZE)
+        ]
+
+    def classify(ad_dicts: List[dict], lemmas: List[List[str]]) -> None:
+        for ad_dict, ad_lemmas in zip(ad_dicts, lemmas):
+            ad_dict["themes"] = lemmas_to_themes(ad_lemmas)
+
+    def insert(ad_dicts: List[dict]) -> None:
+        for page in chunked(ad_dicts, AD_LIMIT_PER_REQUEST):
+            with database.atomic():
+                Ad.insert_many(page).on_conflict_replace().execute()
+                DirtyAd.mark(ad["ad_id"] for ad in page)
+                AdTheme.set_themes({ad["ad_id"]: ad["themes"] for ad in page})
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = SqliteDatabase(
+            os.path.join(directory, "archive.sqlite"), pragmas=DATABASE_PRAGMAS
+        )
+        with database.bind_ctx(MODELS):
+            database.create_tables(MODELS)
+
+            for first_id in range(0, size, SYNTHETIC_ARCHIVE_SLICE_SIZE):
+                api_ads = synthetic_api_ads(
+                    min(SYNTHETIC_ARCHIVE_SLICE_SIZE, size - first_id), first_id
+                )
+                ad_dicts = timed(
+                    "convert",
+                    lambda: [
+                        json_to_ad_dict(api_ad, PARTIES[i % len(PARTIES)])
+                        for i, api_ad in enumerate(api_ads)
+                    ],
+                )
+                if parse_texts:
+                    lemmas = timed("parse", parse, ad_dicts)
+                else:
+                    lemmas = [ad_content(ad_dict).split() for ad_dict in ad_dicts]
+                timed("classify", classify, ad_dicts, lemmas)
+                timed("insert", insert, ad_dicts)
+
+            with synthetic_website():
+                ads = timed("load", load_ads)
+                general_data = timed("general-aggregation", create_general_data, ads)
+                timed("general-rendering", render_general_pages, general_data)
+
+                for party in PARTIES:
+                    party_data = timed(
+                        "party-aggregation",
+                        create_party_data,
+                        party,
+                        ads.for_party(party),
+                    )
+                    timed("party-rendering", render_party_page, party, party_data)
+
+                theme_data = timed("themes-aggregation", create_theme_data, ads)
+                timed("themes-rendering", render_themes_page, theme_data)
+
+        database.close()
+
+    results["total-seconds"] = sum(
+        value for key, value in results.items() if key.endswith("-seconds")
+    )
+    return results
+
+
+@benchmark("cube-slicing")
+def benchmark_cube_slicing(size: int) -> Dict[str, float]:
+    """
+    Compare range sums from the cube with aggregating the ads of a party and theme again.
+
+    Sums a random data type of a random party and theme over a random range of
+    dates for every demographic, and checks that both give the same sums.
+    """
+    with synthetic_archive(size):
+        ads = AdColumns.from_query(
+            Ad.ads_in_time_range(first_date=SEPT_1), first_date=SEPT_1
+        )
+
+    queries = []
+    for _ in range(100):
+        first_date = SEPT_1 + timedelta(days=random.randrange(ads.number_of_dates))
+        queries.append(
+            (
+                random.choice(DATA_TYPES),
+                random.choice(PARTIES),
+                random.choice(Theme.all()),
+                first_date,
+                first_date + timedelta(days=random.randrange(365)),
+            )
+        )
+
+    def rescan(query: tuple) -> np.ndarray:
+        data_type, party, theme, first_date, last_date = query
+        series = (
+            ads.for_party(party).for_theme(theme.value).daily(data_type, DEMOGRAPHICS)
+        )
+        return series[
+            :, (first_date - SEPT_1).days : (last_date - SEPT_1).days + 1
+        ].sum(axis=-1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cube.json")
+
+        start = time.perf_counter()
+        Cube.build(ads, path)
+        build_seconds = time.perf_counter() - start
+
+        cube = Cube.load(path)
+
+        def slice_cube(query: tuple) -> np.ndarray:
+            data_type, party, theme, first_date, last_date = query
+            return cube.range_sum(
+                data_type, party, theme, DEMOGRAPHICS, first_date, last_date
+            )
+
+        for query in queries:
+            assert np.allclose(slice_cube(query), rescan(query), rtol=1e-4, atol=1e-2)
+
+        results = {
+            "rescan-seconds-per-query": seconds_per_item(rescan, queries),
+            "cube-seconds-per-query": seconds_per_item(slice_cube, queries),
+            "cube-build-seconds": build_seconds,
+            "cube-megabytes": os.path.getsize(cube.values.filename) / 2**20,
+        }
+        del cube
+
+    return results
+
+
+@benchmark("theme-aggregation")
+def benchmark_theme_aggregation(size: int) -> Dict[str, float]:
+    """
+    Compare aggregating the impressions of every theme and party per subset of ads, and with the theme matrix.
+
+    The subsets are selected per theme and party, like create_theme_data did
+    before AdColumns.theme_totals. Also times create_theme_data as a whole.
+    """
+    with synthetic_archive(size):
+        ads = AdColumns.from_query(
+            Ad.ads_in_time_range(first_date=SEPT_1), first_date=SEPT_1
+        )
+    theme_values = [t.value for t in Theme.all()]
+
+    def subsets() -> np.ndarray:
+        totals = np.zeros((len(PARTIES), len(theme_values), len(DEMOGRAPHICS)))
+        for theme_i, theme_value in enumerate(theme_values):
+            theme_ads = ads.for_theme(theme_value)
+            for party_i, party in enumerate(PARTIES):
+                totals[party_i, theme_i] = theme_ads.for_party(party).totals(
+                    "impressions", DEMOGRAPHICS
+                )
+        return totals
+
+    def matrix() -> np.ndarray:
+        return ads.theme_totals("impressions", theme_values, PARTIES)[2]
+
+    results = {}
+    for name, aggregate in [
+        ("subsets", subsets),
+        ("matrix", matrix),
+        ("theme-data", lambda: create_theme_data(ads)),
+    ]:
+        start = time.perf_counter()
+        aggregate()
+        results[f"{name}-seconds"] = time.perf_counter() - start
+
+    assert np.allclose(subsets(), matrix())
+    return results
+
+
+@benchmark("rescoring")
+def benchmark_rescoring(size: int) -> Dict[str, float]:
+    """
+    Compare reclassifying the ads that contain a few changed words with reclassifying all ads.
+
+    Both reclassify ads from their lemmas in AdLemma (see classify.rescore_ads),
+    all ads are reclassified by changing every word of the wordlists.
+    """
+    results = {}
+    with synthetic_archive(size) as database:
+        ad_ids = [ad_id for (ad_id,) in Ad.select(Ad.ad_id).tuples()]
+        ad_lemmas = dict(zip(ad_ids, synthetic_lemmas(len(ad_ids))))
+        with database.atomic():
+            start = time.perf_counter()
+            AdLemma.set_lemmas(ad_lemmas)
+            results["indexing-ads-per-second"] = size / (time.perf_counter() - start)
+
+        for name, words in [
+            ("changed-words", set(random.sample(_theme_words(), 3))),
+            ("all-words", set(_theme_words())),
+        ]:
+            with database.atomic():
+                start = time.perf_counter()
+                results[f"{name}-ads"] = rescore_ads(words)
+                results[f"{name}-seconds"] = time.perf_counter() - start
+
+    return results
+
+
+@benchmark("vector-similarity")
+def benchmark_vector_similarity(size: int) -> Dict[str, float]:
+    """
+    Compare the cost per ad of matching lemmas with the wordlists and of scoring their vectors with ThemeCentroids.
+
+    The vectors are random, so the themes differ. Also measures reclassifying a
+    synthetic archive by similarity from AdLemma (see classify.classify_ads_by_similarity).
+    """
+    corpus = synthetic_lemmas(size)
+    centroids = ThemeCentroids(Theme.all(), synthetic_vectors())
+    thresholds = np.full(len(centroids.themes), THEME_SIMILARITY_THRESHOLD)
+
+    results = {
+        "lemma-matching-seconds-per-ad": seconds_per_item(lemmas_to_themes, corpus)
+    }
+
+    # The lemmas are scored in batches, like they are read from AdLemma.
+    batches = []
+    for corpus_batch in chunked(corpus, SIMILARITY_BATCH_SIZE):
+        postings = [Counter(lemmas) for lemmas in corpus_batch]
+        batches.append(
+            (
+                [lemma for counts in postings for lemma in counts],
+                np.array([n for counts in postings for n in counts.values()]),
+                np.cumsum([0] + [len(counts) for counts in postings])[:-1],
+            )
+        )
+
+    start = time.perf_counter()
+    for lemmas, occurrences, ad_starts in batches:
+        centroids.flags(centroids.scores(lemmas, occurrences, ad_starts), thresholds)
+    results["similarity-seconds-per-ad"] = (time.perf_counter() - start) / size
+
+    with synthetic_archive(size) as database:
+        ad_ids = [ad_id for (ad_id,) in Ad.select(Ad.ad_id).tuples()]
+        with database.atomic():
+            AdLemma.set_lemmas(dict(zip(ad_ids, corpus)))
+
+        start = time.perf_counter()
+        classify_ads_by_similarity(centroids, thresholds)
+        results["archive-ads-per-second"] = size / (time.perf_counter() - start)
+
+    return results
+
+
+def import_seconds(modules: List[str] = IMPORT_TIME_MODULES) -> Dict[str, float]:
+    """
+    Measure the cold start import time of modules in a new interpreter with python -X importtime.
+
+    :param modules: The modules to import, in this order.
+    :return: A dict that maps every module to the time it took to import it, including its imports.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {','.join(modules)}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Lines look like "import time: <self us> | <cumulative us> | <indented module>".
+    seconds = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        _, cumulative_us, module = line.removeprefix("import time:").split("|")
+        if module.strip() in modules and not module[1:].startswith(" "):
+            seconds[module.strip()] = int(cumulative_us) / 1e6
+
+    return seconds
+
+
+@benchmark("import-time")
+def benchmark_import_time(size: int) -> Dict[str, float]:
+    """
+    Measure the cold start import time of IMPORT_TIME_MODULES, see import_seconds.
+
+    The size is not used, see tests/test_import_time.py for its budget.
+    """
+    results = {
+        f"{module}-import-seconds": seconds
+        for module, seconds in import_seconds().items()
+    }
+    results["total-import-seconds"] = sum(results.values())
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        "-b",
+        "--benchmarks",
+        help=f"Comma separated benchmarks to run ({','.join(BENCHMARKS)}).",
+    )
+    parser.add_argument(
+        "-s",
+        "--size",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        default=[1000],
+        help="Comma separated sizes to run every benchmark with, e.g. 10000,100000,1000000.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--history",
+        default=BENCHMARK_HISTORY_PATH,
+        help="The file that the results are appended to and compared with.",
+    )
+    parser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="Do not append the results to the history file.",
+    )
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="Exit with an error if a result regressed since the last run.",
+    )
+
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    history = read_history(args.history)
+    commit = git_commit()
+    regressed = False
+
+    names = args.benchmarks.split(",") if args.benchmarks else list(BENCHMARKS)
+    for name in names:
+        for size in args.size:
+            logging.info(f"Running {name} ({size}).")
+            results = BENCHMARKS[name](size)
+            for key, value in results.items():
+                logging.info(f"{name}: {key} = {value:.3g}")
+
+            previous_runs = [
+                run
+                for run in history
+                if run["benchmark"] == name and run["size"] == size
+            ]
+            if previous_runs:
+                for message in regressions(previous_runs[-1]["results"], results):
+                    logging.warning(
+                        f"{name} ({size}) regressed since {previous_runs[-1]['date']}: "
+                        f"{message}."
+                    )
+                    regressed = True
+
+            if not args.no_history:
+                append_history(
+                    args.history,
+                    {
+                        "benchmark": name,
+                        "size": size,
+                        "seed": args.seed,
+                        "commit": commit,
+                        "date": datetime.now().isoformat(timespec="seconds"),
+                        "results": results,
+                    },
+                )
+
+    if regressed and args.fail_on_regression:
+        sys.exit(1)
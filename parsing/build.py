@@ -0,0 +1,80 @@
+import argparse
+import logging
+
+from models import create_tables, use_read_only_database
+from processing import (
+    create_general_data,
+    create_theme_data,
+    load_ads,
+    load_daily_aggregates,
+    render_general_pages,
+    render_party_pages,
+    render_themes_page,
+)
+from cube import Cube
+from metrics import instrumented_run
+from utils import write_manifest
+
+logging.basicConfig(
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Only recompute the daily series of ads that changed since the last build.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="The number of processes that render the party pages.",
+    )
+    parser.add_argument(
+        "--cube",
+        action="store_true",
+        help="Also aggregate the ads into the cube of daily amounts per party, theme and demographic.",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Profile the run with cProfile and write the statistics to PATH.",
+    )
+
+    args = parser.parse_args()
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    with instrumented_run("build", args.profile):
+        # The daily aggregates store removes the marks of the ads it refreshed from DirtyAd.
+        if args.incremental:
+            create_tables()
+        else:
+            use_read_only_database()
+
+        ads = load_ads()
+        logging.info(f"Loaded {len(ads)} ads.")
+
+        daily_aggregates = load_daily_aggregates() if args.incremental else None
+
+        if args.cube:
+            logging.info("Building the cube.")
+            Cube.build(ads)
+
+        logging.info("Creating general data.")
+        changed_paths = render_general_pages(create_general_data(ads, daily_aggregates))
+
+        changed_paths += render_party_pages(ads, daily_aggregates, args.jobs)
+
+        changed_paths += render_themes_page(create_theme_data(ads))
+
+        write_manifest(changed_paths)
+        logging.info(f"Changed {len(changed_paths)} files.")
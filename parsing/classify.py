@@ -0,0 +1,400 @@
+import argparse
+import hashlib
+import importlib.metadata
+import json
+import logging
+import os
+from itertools import groupby
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+from peewee import chunked
+from unidecode import unidecode
+
+from constants import (
+    CACHE_LOOKUP_BATCH_SIZE,
+    NLP_BATCH_SIZE,
+    NLP_MODEL,
+    SIMILARITY_BATCH_SIZE,
+    THEME_SIMILARITY_THRESHOLD,
+    UNCLASSIFIED_THEMES,
+)
+from metrics import count, instrumented_run, timer
+from models import (
+    Ad,
+    AdLemma,
+    AdTheme,
+    ThemeCache,
+    ThemeClassifier,
+    ThemeWord,
+    create_tables,
+    database_handler,
+)
+from parsing import ad_content, nlp, doc_to_lemmas, lemmas_to_themes
+from similarity import ThemeCentroids, theme_centroids
+from themes import Theme, theme_matcher
+
+logging.basicConfig(
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+def unclassified_ads(chunk_size: int) -> Iterator[List[Tuple[int, str, str]]]:
+    """
+    Yield chunks of ads whose themes are not classified yet.
+
+    Ads are read in chunks ordered by their id, so the table can be updated in between chunks.
+
+    :param chunk_size: The maximum number of ads in a chunk.
+    :return: Lists of tuples with the id, the ad id and the content of an ad.
+    """
+    last_id = 0
+    while True:
+        chunk = [
+            (ad["id"], ad["ad_id"], unidecode(ad_content(ad)))
+            for ad in Ad.select(
+                Ad.id,
+                Ad.ad_id,
+                Ad.creative_bodies,
+                Ad.creative_link_descriptions,
+                Ad.creative_link_titles,
+            )
+            .where((Ad.themes == UNCLASSIFIED_THEMES) & (Ad.id > last_id))
+            .order_by(Ad.id)
+            .limit(chunk_size)
+            .dicts()
+        ]
+        if not chunk:
+            return
+
+        yield chunk
+        last_id = chunk[-1][0]
+
+
+def model_version() -> str:
+    """Return the name and version of the spaCy model, which is part of the cache key."""
+    return f"{NLP_MODEL}-{importlib.metadata.version(NLP_MODEL)}"
+
+
+def content_hash(content: str, version: str) -> str:
+    """Return the key of the theme cache for a parsed ad text."""
+    return hashlib.sha256(f"{version}\n{content}".encode()).hexdigest()
+
+
+def cached_themes(
+    content_hashes: Iterable[str],
+) -> Tuple[Dict[str, int], Dict[str, List[str]], List[ThemeCache]]:
+    """
+    Return the cached themes and lemmas of parsed ad texts.
+
+    Cache entries of which the wordlists changed are reclassified from their cached lemmas,
+    they are returned so the caller can write them.
+
+    :param content_hashes: The keys of the parsed ad texts.
+    :return: Dicts that map the keys that are cached to the flags of their themes, and to their
+        lemmas, and the reclassified cache entries.
+    """
+    matcher = theme_matcher()
+    themes = {}
+    lemmas = {}
+    stale_entries = []
+    for content_hashes_batch in chunked(content_hashes, CACHE_LOOKUP_BATCH_SIZE):
+        for entry in ThemeCache.select().where(
+            ThemeCache.content_hash.in_(content_hashes_batch)
+        ):
+            lemmas[entry.content_hash] = json.loads(entry.lemmas)
+            if entry.wordlist_version != matcher.version:
+                entry.themes = lemmas_to_themes(lemmas[entry.content_hash])
+                entry.wordlist_version = matcher.version
+                stale_entries.append(entry)
+
+            themes[entry.content_hash] = entry.themes
+
+    return themes, lemmas, stale_entries
+
+
+def classify_ads(batch_size: int, n_process: int) -> None:
+    """
+    Classify the themes of all unclassified ads.
+
+    Texts that were parsed before (by the same spaCy model) are not parsed again,
+    see ThemeCache. The lemmas of the ads are stored in AdLemma.
+
+    :param batch_size: The number of ads that are parsed by spaCy at once.
+    :param n_process: The number of processes that parse ads.
+    """
+    version = model_version()
+    ThemeCache.delete().where(ThemeCache.model_version != version).execute()
+
+    # Every process gets at least a few batches per chunk.
+    chunk_size = batch_size * n_process * 4
+
+    for chunk in unclassified_ads(chunk_size):
+        ad_hashes = [
+            (id_, ad_id, content_hash(content, version))
+            for id_, ad_id, content in chunk
+        ]
+        contents = {h: content for (_, _, h), (_, _, content) in zip(ad_hashes, chunk)}
+
+        themes, lemmas, stale_entries = cached_themes(contents.keys())
+        uncached_contents = [
+            (content, h) for h, content in contents.items() if h not in themes
+        ]
+
+        # Texts are parsed outside of a transaction, so the archive is only locked while the results are written.
+        cache_entries = []
+        # The model is only loaded (and processes only started) if a text is not cached.
+        if uncached_contents:
+            with timer("spacy-parse"):
+                for doc, h in nlp().pipe(
+                    uncached_contents,
+                    as_tuples=True,
+                    batch_size=batch_size,
+                    n_process=n_process,
+                ):
+                    lemmas[h] = doc_to_lemmas(doc)
+                    themes[h] = lemmas_to_themes(lemmas[h])
+                    cache_entries.append(
+                        {
+                            "content_hash": h,
+                            "model_version": version,
+                            "lemmas": json.dumps(lemmas[h]),
+                            "themes": themes[h],
+                            "wordlist_version": theme_matcher().version,
+                        }
+                    )
+
+        with database_handler.atomic(), timer("database-update"):
+            if stale_entries:
+                ThemeCache.bulk_update(
+                    stale_entries,
+                    fields=[ThemeCache.themes, ThemeCache.wordlist_version],
+                    batch_size=CACHE_LOOKUP_BATCH_SIZE,
+                )
+            if cache_entries:
+                ThemeCache.insert_many(cache_entries).on_conflict_replace().execute()
+            Ad.bulk_update(
+                [Ad(id=id_, themes=themes[h]) for id_, _, h in ad_hashes],
+                fields=[Ad.themes],
+                batch_size=batch_size,
+            )
+            AdTheme.set_themes({ad_id: themes[h] for _, ad_id, h in ad_hashes})
+            AdLemma.set_lemmas({ad_id: lemmas[h] for _, ad_id, h in ad_hashes})
+
+        count("ads-classified", len(chunk))
+        count("texts-parsed", len(uncached_contents))
+
+        logging.info(
+            f"Classified {len(chunk)} ads "
+            f"({len(chunk) - len(uncached_contents)} cached)."
+        )
+
+
+def rescore_ads(words: Set[str]) -> int:
+    """
+    Reclassify the themes of the classified ads that contain any of the words.
+
+    When words are added to or removed from wordlists, the themes of other ads
+    do not change. The ads are reclassified from their lemmas in AdLemma, so no
+    text is parsed.
+
+    :param words: The words that were added to or removed from wordlists.
+    :return: The number of reclassified ads.
+    """
+    ids = dict(
+        Ad.select(Ad.ad_id, Ad.id)
+        .where((Ad.themes != UNCLASSIFIED_THEMES) & Ad.ad_id.in_(AdLemma.ad_ids(words)))
+        .tuples()
+    )
+
+    for ad_ids in chunked(ids, CACHE_LOOKUP_BATCH_SIZE):
+        themes = {
+            ad_id: lemmas_to_themes(lemmas)
+            for ad_id, lemmas in AdLemma.lemmas(ad_ids).items()
+        }
+        Ad.bulk_update(
+            [Ad(id=ids[ad_id], themes=flags) for ad_id, flags in themes.items()],
+            fields=[Ad.themes],
+            batch_size=CACHE_LOOKUP_BATCH_SIZE,
+        )
+        AdTheme.set_themes(themes)
+
+    return len(ids)
+
+
+def rescore_changed_wordlists() -> None:
+    """
+    Reclassify the ads whose themes changed since the wordlists were stored, and store the current wordlists.
+
+    If no wordlists were stored yet, the lemmas of the classified ads are not
+    known, so all ads are classified again (mostly from ThemeCache).
+    """
+    with database_handler.atomic(), timer("rescoring"):
+        if not ThemeWord.select().exists():
+            if Ad.select().where(Ad.themes != UNCLASSIFIED_THEMES).exists():
+                logging.info("Indexing the lemmas of all ads, which reclassifies them.")
+                Ad.update(themes=UNCLASSIFIED_THEMES).execute()
+                AdTheme.delete().execute()
+
+        else:
+            words = ThemeWord.changed_words()
+            if words:
+                n_ads = rescore_ads(words)
+                count("ads-rescored", n_ads)
+                logging.info(
+                    f"Reclassified {n_ads} ads with {len(words)} changed words."
+                )
+
+        ThemeWord.store()
+
+
+def classify_ads_by_similarity(
+    centroids: ThemeCentroids,
+    thresholds: np.ndarray,
+    batch_size: int = SIMILARITY_BATCH_SIZE,
+) -> int:
+    """
+    Reclassify the themes of all classified ads by the similarity of their lemmas to the themes.
+
+    The ads are scored in batches from their lemmas in AdLemma, so no text is
+    parsed. Only the ads whose themes changed are written.
+
+    :param centroids: The centroids of the themes.
+    :param thresholds: The minimum similarity of every theme of the centroids.
+    :param batch_size: The number of ads that are scored at once.
+    :return: The number of ads whose themes changed.
+    """
+    n_changed = 0
+    last_id = 0
+    while True:
+        batch = list(
+            Ad.select(Ad.id, Ad.ad_id, Ad.themes)
+            .where((Ad.themes != UNCLASSIFIED_THEMES) & (Ad.id > last_id))
+            .order_by(Ad.id)
+            .limit(batch_size)
+            .tuples()
+        )
+        if not batch:
+            return n_changed
+        last_id = batch[-1][0]
+
+        # Ads have dozens of lemmas, which are read without the row conversion of peewee.
+        postings = AdLemma._meta.database.execute(
+            AdLemma.select(AdLemma.ad_id, AdLemma.lemma, AdLemma.occurrences)
+            .where(AdLemma.ad_id.in_([ad_id for _, ad_id, _ in batch]))
+            .order_by(AdLemma.ad_id)
+        ).fetchall()
+
+        # Ads without lemmas do not have a theme.
+        themes = dict.fromkeys((ad_id for _, ad_id, _ in batch), Theme.NONE.value)
+        if postings:
+            ad_ids, lemmas, occurrences = zip(*postings)
+            ad_starts = np.cumsum([0] + [len(list(g)) for _, g in groupby(ad_ids)])[:-1]
+            themes.update(
+                zip(
+                    (ad_ids[i] for i in ad_starts),
+                    centroids.flags(
+                        centroids.scores(lemmas, np.array(occurrences), ad_starts),
+                        thresholds,
+                    ).tolist(),
+                )
+            )
+
+        changed = [
+            (id_, ad_id)
+            for id_, ad_id, old_themes in batch
+            if themes[ad_id] != old_themes
+        ]
+        with database_handler.atomic():
+            Ad.bulk_update(
+                [Ad(id=id_, themes=themes[ad_id]) for id_, ad_id in changed],
+                fields=[Ad.themes],
+                batch_size=CACHE_LOOKUP_BATCH_SIZE,
+            )
+            AdTheme.set_themes({ad_id: themes[ad_id] for _, ad_id in changed})
+
+        n_changed += len(changed)
+
+
+def parse_thresholds(arguments: Optional[List[str]], themes: List[Theme]) -> np.ndarray:
+    """
+    Return the similarity threshold of every theme from arguments.
+
+    :param arguments: Values like "0.6" (for all themes) or "CLIMATE=0.6" (for a theme).
+    :param themes: The themes of the thresholds.
+    """
+    thresholds = {theme.name: THEME_SIMILARITY_THRESHOLD for theme in themes}
+    for argument in arguments or []:
+        name, _, value = argument.rpartition("=")
+        if not name:
+            thresholds = dict.fromkeys(thresholds, float(value))
+        elif name.upper() in thresholds:
+            thresholds[name.upper()] = float(value)
+        else:
+            raise ValueError(f"Unknown theme in threshold {argument}.")
+
+    return np.array([thresholds[theme.name] for theme in themes], dtype=np.float32)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("-a", "--all", action="store_true", help="Reclassify all ads.")
+    parser.add_argument("-b", "--batch-size", type=int, default=NLP_BATCH_SIZE)
+    parser.add_argument("-n", "--processes", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--vectors",
+        action="store_true",
+        help="Reclassify all ads by the similarity of their word vectors to the wordlists.",
+    )
+    parser.add_argument(
+        "--threshold",
+        action="append",
+        metavar="[THEME=]SIMILARITY",
+        help="The minimum similarity of a theme with --vectors "
+        f"(default {THEME_SIMILARITY_THRESHOLD}), for all themes or one theme.",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Profile the run with cProfile and write the statistics to PATH.",
+    )
+
+    args = parser.parse_args()
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+    thresholds = parse_thresholds(args.threshold, Theme.all())
+
+    classifier = ThemeClassifier.VECTORS if args.vectors else ThemeClassifier.WORDLISTS
+
+    with instrumented_run("classify", args.profile):
+        create_tables()
+
+        # Ads are classified one way, new ads are not classified by wordlists while the others are classified by vectors.
+        current_classifier = ThemeClassifier.current()
+        if args.all:
+            Ad.update(themes=UNCLASSIFIED_THEMES).execute()
+            AdTheme.delete().execute()
+            AdLemma.delete().execute()
+            current_classifier = ThemeClassifier.WORDLISTS
+
+        elif current_classifier == ThemeClassifier.VECTORS and not args.vectors:
+            parser.error(
+                "The ads are classified by word vectors, run with --vectors, "
+                "or with --all to classify all ads by wordlists."
+            )
+
+        # Reclassifying ads by vectors replaces the themes of all ads, so their wordlist themes are not rescored.
+        if current_classifier == ThemeClassifier.WORDLISTS:
+            rescore_changed_wordlists()
+        ThemeClassifier.store(classifier)
+
+        classify_ads(args.batch_size, args.processes)
+
+        if args.vectors:
+            with timer("similarity"):
+                n_changed = classify_ads_by_similarity(theme_centroids(), thresholds)
+            logging.info(f"Reclassified {n_changed} ads by similarity.")
@@ -2,10 +2,46 @@ import os
 from datetime import date
 
 LOCAL_AD_ARCHIVE_PATH = "../data/local_ad_archive.sqlite"
+# How long a connection waits for a lock held by another connection.
+DATABASE_TIMEOUT_SECONDS = 30
+# WAL mode lets the processing scripts read while download.py writes.
+DATABASE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+}
+READ_ONLY_DATABASE_PRAGMAS = {
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "query_only": 1,
+}
+DAILY_AGGREGATES_PATH = "../data/daily_aggregates.npz"
+# The daily amounts of every party, theme, data type and demographic (see cube.py).
+CUBE_PATH = "../data/cube.json"
+# The daily series of the rendered pages, which the line charts load (see utils.write_chart_data).
+CHART_DATA_PATH = "../website/data"
+# The files that the last build changed, which publishing ships (see utils.write_manifest).
+CHANGED_FILES_PATH = "../data/changed_files.txt"
+# A summary of the timers and counters of every run of a script (see metrics.instrumented_run).
+RUN_SUMMARY_PATH = "../data/run_summaries.jsonl"
+# Raw API responses, stored as <date>/<party>.jsonl.gz (see archive.py).
+RESPONSE_ARCHIVE_PATH = "../data/responses"
 
 AD_LIMIT_PER_REQUEST = 1000
 MAX_PAGE_IDS_PER_REQUEST = 10
 
+DOWNLOAD_JOBS = 4
+# Responses are parsed in chunks and their ads are written in batches.
+STREAM_CHUNK_SIZE = 64 * 1024
+INSERT_BATCH_SIZE = 250
+REQUEST_TIMEOUT_SECONDS = 60
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 2
+
+# Error codes of the Facebook API that indicate rate limiting.
+RATE_LIMIT_ERROR_CODES = [4, 17, 32, 613]
+
 FACEBOOK_API_VERSION = "v13.0"
 
 FACEBOOK_API_FIELDS = [
@@ -28,8 +64,10 @@ FACEBOOK_API_FIELDS = [
 ]
 
 FACEBOOK_API_ACCESS_TOKEN = os.getenv("FACEBOOK_ACCESS_TOKEN")
+# Can be pointed to a local server that serves recorded responses.
+FACEBOOK_API_HOST = os.getenv("FACEBOOK_API_HOST", "https://graph.facebook.com")
 FACEBOOK_API_URL = (
-    f"https://graph.facebook.com/{FACEBOOK_API_VERSION}/ads_archive?"
+    f"{FACEBOOK_API_HOST}/{FACEBOOK_API_VERSION}/ads_archive?"
     f"access_token={FACEBOOK_API_ACCESS_TOKEN}&"
     f"limit={AD_LIMIT_PER_REQUEST}&"
     f"fields={','.join(FACEBOOK_API_FIELDS)}&"
@@ -122,4 +160,29 @@ DEMOGRAPHIC_TYPE_TO_LIST_MAP = {
     "region": REGIONS,
 }
 
+# The value of Ad.themes of ads whose themes have not been classified yet.
+UNCLASSIFIED_THEMES = -1
+
+NLP_MODEL = "nl_core_news_lg"
+
+# Only the components that set the part-of-speech tags and lemmas are needed.
+NLP_DISABLED_COMPONENTS = ["parser", "senter", "ner"]
+NLP_BATCH_SIZE = 256
+# The number of keys that are looked up in the theme cache per query.
+CACHE_LOOKUP_BATCH_SIZE = 500
+
+# The minimum cosine similarity between an ad and the centroid of a theme, see similarity.ThemeCentroids.
+THEME_SIMILARITY_THRESHOLD = 0.5
+# The number of ads whose similarities are computed at once, which bounds the memory of their word vectors.
+SIMILARITY_BATCH_SIZE = 1000
+
 DATA_TYPES = ["number-of-ads", "spending", "impressions", "estimated-audience-size"]
+# The number of decimals that the amounts of every data type are shown with, None rounds to ints.
+DATA_TYPE_PRECISIONS = {
+    "number-of-ads": None,
+    "spending": 2,
+    "impressions": None,
+    "estimated-audience-size": None,
+}
+# The data types that are shown on the party pages.
+PARTY_PAGE_DATA_TYPES = ["spending", "impressions"]
@@ -0,0 +1,215 @@
+import glob
+import json
+import os
+import tempfile
+from datetime import date, timedelta
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+from aggregation import AdColumns, daily_sums_to_series
+from constants import CUBE_PATH, DATA_TYPES, DEMOGRAPHICS, PARTIES
+from metrics import timer
+from themes import Theme
+from utils import write_atomically
+
+# The first entry of the theme axis holds all ads, the other entries the ads of a theme.
+ALL_THEMES = "All"
+
+
+class Cube:
+    """
+    A dense cube of the daily amounts of every party, theme, data type and demographic.
+
+    The amounts are stored as a (parties x themes x data types x demographics x dates)
+    float32 array in a .npy file, which is memory-mapped when it is loaded. The cube
+    file is a JSON file with the labels of the axes and the name of the array file
+    next to it, so replacing it switches to a new array at once. The date axis spans
+    the dates on which ads were active. An ad counts towards every theme it has, so
+    amounts of different themes should not be added up.
+    """
+
+    def __init__(self, values: np.ndarray, first_date: date, axes: Dict[str, list]):
+        """
+        Create a cube from its array.
+
+        :param values: The amounts, see Cube.
+        :param first_date: The date of the first entry of the date axis.
+        :param axes: The labels of the party, theme, data type and demographic axes.
+        """
+        self.values = values
+        self.first_date = first_date
+        self.axes = axes
+        self._indices = {
+            name: {label: i for i, label in enumerate(labels)}
+            for name, labels in axes.items()
+        }
+
+    @property
+    def last_date(self) -> date:
+        """Return the date of the last entry of the date axis."""
+        return self.first_date + timedelta(days=self.values.shape[-1] - 1)
+
+    @classmethod
+    @timer("cube")
+    def build(cls, ads: AdColumns, path: str = CUBE_PATH) -> "Cube":
+        """
+        Aggregate ads into a cube file, and load it.
+
+        The array is written to a new file, which the cube file points to when it is complete.
+        The arrays of older cubes are removed.
+
+        :param ads: The ads, the dates on which they were active are the date axis of the cube.
+        :param path: The path of the cube file.
+        """
+        axes = {
+            "parties": PARTIES,
+            "themes": [ALL_THEMES] + Theme.titles(),
+            "data_types": DATA_TYPES,
+            "demographics": DEMOGRAPHICS,
+        }
+
+        # The dates before the first ad started and after the last ad ended are all zeros.
+        if ads.active.any():
+            first_index = int(ads.start_indices[ads.active].min())
+            end_index = int(ads.end_indices[ads.active].max()) + 1
+        else:
+            first_index, end_index = 0, 1
+
+        array_prefix = f"{os.path.splitext(os.path.basename(path))[0]}."
+        handle, array_path = tempfile.mkstemp(
+            suffix=".npy", prefix=array_prefix, dir=os.path.dirname(path) or "."
+        )
+        os.close(handle)
+
+        values = np.lib.format.open_memmap(
+            array_path,
+            mode="w+",
+            dtype=np.float32,
+            shape=tuple(len(labels) for labels in axes.values())
+            + (end_index - first_index,),
+        )
+
+        for party_i, party in enumerate(PARTIES):
+            party_ads = ads.for_party(party)
+            for theme_i, theme in enumerate([None] + Theme.all()):
+                theme_ads = (
+                    party_ads if theme is None else party_ads.for_theme(theme.value)
+                )
+                if len(theme_ads) == 0:
+                    continue
+
+                for data_type_i, data_type in enumerate(DATA_TYPES):
+                    values[party_i, theme_i, data_type_i] = daily_sums_to_series(
+                        *theme_ads.daily_sums(data_type, DEMOGRAPHICS)
+                    )[:, first_index:end_index]
+
+        values.flush()
+        del values
+
+        first_date = ads.first_date + timedelta(days=first_index)
+        write_atomically(
+            path,
+            json.dumps(
+                {
+                    "first_date": first_date.isoformat(),
+                    "axes": axes,
+                    "values": os.path.basename(array_path),
+                }
+            ).encode(),
+        )
+
+        # Readers that memory-mapped an older array keep reading it after it is removed.
+        for old_array_path in glob.glob(
+            os.path.join(
+                glob.escape(os.path.dirname(path)), f"{glob.escape(array_prefix)}*.npy"
+            )
+        ):
+            if os.path.basename(old_array_path) != os.path.basename(array_path):
+                os.remove(old_array_path)
+
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path: str = CUBE_PATH) -> Optional["Cube"]:
+        """Memory-map the array of a cube file, or return None if it does not exist."""
+        if not os.path.exists(path):
+            return None
+
+        # A cube that is built at the same time can remove the array between reading the cube file and the array.
+        for _ in range(3):
+            with open(path) as h_cube:
+                metadata = json.load(h_cube)
+
+            try:
+                values = np.load(
+                    os.path.join(os.path.dirname(path), metadata["values"]),
+                    mmap_mode="r",
+                )
+            except FileNotFoundError:
+                continue
+
+            return cls(
+                values,
+                date.fromisoformat(metadata["first_date"]),
+                metadata["axes"],
+            )
+
+        raise FileNotFoundError(f"The array of cube {path} was removed while loading.")
+
+    def daily(
+        self,
+        data_type: str,
+        party: Optional[str] = None,
+        theme: Optional[Theme] = None,
+        demographics: Sequence[str] = ("total",),
+        first_date: Optional[date] = None,
+        last_date: Optional[date] = None,
+    ) -> np.ndarray:
+        """
+        Return a slice of the cube as a (demographics x dates) array.
+
+        Only the slice is read from the file. Dates outside of the date axis of the cube
+        have no ads, so they are left out.
+
+        :param data_type: The data type, see DATA_TYPES.
+        :param party: The party, defaults to the sum of all parties.
+        :param theme: The theme, defaults to all ads.
+        :param demographics: The demographics, see DEMOGRAPHICS.
+        :param first_date: The first date of the slice, defaults to the first date of the cube.
+        :param last_date: The last date of the slice (inclusive), defaults to the last date of the cube.
+        """
+        theme_i = self._indices["themes"][ALL_THEMES if theme is None else theme.title]
+        data_type_i = self._indices["data_types"][data_type]
+        demographic_indices = [self._indices["demographics"][d] for d in demographics]
+
+        start = max((first_date - self.first_date).days, 0) if first_date else 0
+        end = (
+            max((last_date - self.first_date).days + 1, 0)
+            if last_date
+            else self.values.shape[-1]
+        )
+
+        if party is not None:
+            party_i = self._indices["parties"][party]
+            return self.values[party_i, theme_i, data_type_i][
+                demographic_indices, start:end
+            ]
+
+        return self.values[:, theme_i, data_type_i][
+            :, demographic_indices, start:end
+        ].sum(axis=0, dtype=np.float64)
+
+    def range_sum(
+        self,
+        data_type: str,
+        party: Optional[str] = None,
+        theme: Optional[Theme] = None,
+        demographics: Sequence[str] = ("total",),
+        first_date: Optional[date] = None,
+        last_date: Optional[date] = None,
+    ) -> np.ndarray:
+        """Return the sum of the daily amounts from first_date up to and including last_date per demographic, see Cube.daily."""
+        return self.daily(
+            data_type, party, theme, demographics, first_date, last_date
+        ).sum(axis=-1, dtype=np.float64)
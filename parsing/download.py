@@ -1,20 +1,34 @@
 import argparse
 import csv
 import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import date, timedelta
-from typing import List
+from typing import List, Optional
 
 import requests
+from peewee import chunked
+from requests.adapters import HTTPAdapter
 
+from archive import append_ads, read_ads, shard_party, shard_paths
 from constants import (
     DATETIME_FORMAT,
+    DOWNLOAD_JOBS,
     FACEBOOK_API_URL,
     MAX_PAGE_IDS_PER_REQUEST,
+    MAX_RETRIES,
     PARTIES,
     FIRST_DATE,
+    INSERT_BATCH_SIZE,
+    RATE_LIMIT_ERROR_CODES,
+    REQUEST_TIMEOUT_SECONDS,
+    RETRY_BACKOFF_SECONDS,
+    STREAM_CHUNK_SIZE,
 )
-from models import Ad
-from parsing import json_to_ad_dict
+from metrics import count, counted_bytes, instrumented_run, timer
+from models import Ad, AdTheme, DirtyAd, create_tables, database_handler
+from parsing import AdStream, json_to_ad_dict
 
 logging.basicConfig(
     format="[%(asctime)s] %(levelname)s: %(message)s",
@@ -22,32 +36,209 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+# Serializes writes to the database from the download threads.
+DATABASE_LOCK = threading.Lock()
 
-def download_ads(api_url: str, current_party: str) -> None:
+
+def create_session(jobs: int) -> requests.Session:
+    """Create a session with a connection pool that is shared by all download threads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class APIError(Exception):
+    """An error returned by the Facebook Ad Library API."""
+
+    def __init__(self, error: dict):
+        """
+        Create an exception from the error member of a response.
+
+        :param error: The error returned by the API.
+        """
+        super().__init__(error)
+        self.error = error
+
+    @property
+    def is_retryable(self) -> bool:
+        """Return whether the request can be retried, i.e. it was rate limited or the error is transient."""
+        return self.error.get("code") in RATE_LIMIT_ERROR_CODES or self.error.get(
+            "is_transient", False
+        )
+
+
+def write_ads(ad_dicts: List[dict]) -> None:
+    """
+    Insert or replace ads in the archive.
+
+    All statements are executed in one transaction.
+
+    :param ad_dicts: Dicts that correspond with the Ad model.
+    """
+    with DATABASE_LOCK, timer("database-insert"), database_handler.atomic():
+        Ad.insert_many(ad_dicts).on_conflict_replace().execute()
+        DirtyAd.mark(ad["ad_id"] for ad in ad_dicts)
+        AdTheme.set_themes({ad["ad_id"]: ad["themes"] for ad in ad_dicts})
+
+    count("ads-written", len(ad_dicts))
+
+
+def download_page(
+    session: requests.Session, api_url: str, current_party: str, archive: bool
+) -> Optional[str]:
+    """
+    Request a single page from the Facebook Ad Library API and write its ads.
+
+    The response is parsed while it is received, and the ads are written in batches of INSERT_BATCH_SIZE.
+
+    :param session: The session to request the page with.
+    :param api_url: The url to request.
+    :param current_party: The party we are requesting ads for.
+    :param archive: Whether to append the raw ads to the response archive.
+    :return: The url of the next page, or None if this is the last page.
+    """
+    count("http-requests")
+    with timer("http-latency"):
+        response = session.get(api_url, timeout=REQUEST_TIMEOUT_SECONDS, stream=True)
+
+    with response:
+        ad_stream = AdStream(
+            counted_bytes("http-bytes", response.iter_content(STREAM_CHUNK_SIZE))
+        )
+
+        number_of_ads = 0
+        for ads in chunked(ad_stream, INSERT_BATCH_SIZE):
+            if archive:
+                append_ads(current_party, ads)
+
+            with timer("ad-conversion"):
+                ad_dicts = [json_to_ad_dict(ad, current_party) for ad in ads]
+            write_ads(ad_dicts)
+            number_of_ads += len(ads)
+
+    if ad_stream.error is not None:
+        raise APIError(ad_stream.error)
+
+    if number_of_ads > 0:
+        logging.info(f"Got {number_of_ads} ads ({current_party})")
+
+    return ad_stream.paging.get("next")
+
+
+def download_ads(
+    session: requests.Session, api_url: str, current_party: str, archive: bool = False
+) -> None:
     """
     Request ads from the Facebook Ad Library API.
 
     Parse and write all found ads.
-    If the request returns a paging url, a recursive call is made to follow that url.
+    The paging urls returned by the API are followed until the last page.
+    Connection errors, rate limits and transient API errors are retried with exponential backoff.
+    Retrying a page that was partially written is safe, because ads are replaced.
 
-    :param api_url: The url to request.
+    :param session: The session to request the pages with.
+    :param api_url: The url of the first page.
     :param current_party: The party we are requesting ads for.
+    :param archive: Whether to append the raw ads to the response archive.
+    """
+    attempt = 0
+    while api_url is not None:
+        try:
+            api_url = download_page(session, api_url, current_party, archive)
+            attempt = 0
+            continue
+        except APIError as e:
+            if not e.is_retryable:
+                logging.error(f"Error from API: '{e.error}'")
+                count("http-failures")
+                return
+            error = e.error
+        except (requests.RequestException, ValueError) as e:
+            error = e
+
+        if attempt == MAX_RETRIES:
+            logging.error(f"Request failed after {MAX_RETRIES} retries: '{error}'")
+            count("http-failures")
+            return
+
+        delay = RETRY_BACKOFF_SECONDS * 2**attempt
+        logging.warning(f"Request failed ('{error}'), retrying in {delay}s.")
+        count("http-retries")
+        time.sleep(delay)
+        attempt += 1
+
+
+def download_all(
+    parties: List[str], min_date: date, jobs: int, archive: bool = False
+) -> None:
+    """
+    Download the ads of the Facebook pages of parties.
+
+    :param parties: The parties to download the ads of.
+    :param min_date: Only download ads that were active since this date.
+    :param jobs: The number of requests that are made concurrently.
+    :param archive: Whether to append the raw ads to the response archive.
+    """
+    page_ids_per_party = parse_facebook_page_ids(parties)
+
+    api_session = create_session(jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for party, page_ids in page_ids_per_party.items():
+
+            for i in range(0, len(page_ids), MAX_PAGE_IDS_PER_REQUEST):
+                page_ids_subset = page_ids[i : i + MAX_PAGE_IDS_PER_REQUEST]
+
+                logging.debug(
+                    f"Queueing download of ads of {len(page_ids_subset)}"
+                    f" pages ({i}/{len(page_ids)}) ({party})"
+                )
+
+                futures.append(
+                    executor.submit(
+                        download_ads,
+                        api_session,
+                        FACEBOOK_API_URL.format(
+                            page_ids=",".join(page_ids_subset),
+                            min_date=min_date.strftime(DATETIME_FORMAT),
+                        ),
+                        party,
+                        archive,
+                    )
+                )
+
+        for future in futures:
+            future.result()
+
+
+def parse_shard(path: str) -> List[dict]:
+    """Parse the raw ads in a shard of the response archive into dicts that correspond with the Ad model."""
+    party = shard_party(path)
+    return [json_to_ad_dict(ad, party) for ad in read_ads(path)]
+
+
+def replay_archive(parties: List[str], jobs: int) -> None:
     """
-    response = requests.get(api_url)
-    response_data = response.json()
+    Parse the ads in the response archive again and write them, without requesting the API.
+
+    Shards are parsed by a pool of processes and written in the order they were
+    downloaded, so the latest version of an ad is kept. Ads that are not in the
+    archive are left as they are.
 
-    if "error" in response_data:
-        logging.error(f"Error from API: '{response_data['error']}'")
-        return
+    :param parties: The parties to replay the ads of.
+    :param jobs: The number of processes that parse shards.
+    """
+    paths = shard_paths(parties)
+    logging.info(f"Replaying {len(paths)} shards.")
 
-    if len(response_data["data"]) > 0:
-        logging.info(f"Got {len(response_data['data'])} ads ({current_party})")
-        Ad.insert_many(
-            json_to_ad_dict(ad, current_party) for ad in response_data["data"]
-        ).on_conflict_replace().execute()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for path, ad_dicts in zip(paths, executor.map(parse_shard, paths)):
+            for ad_dicts_chunk in chunked(ad_dicts, INSERT_BATCH_SIZE):
+                write_ads(ad_dicts_chunk)
 
-    if "paging" in response_data:
-        download_ads(response_data["paging"]["next"], current_party)
+            logging.info(f"Replayed {len(ad_dicts)} ads ({path})")
 
 
 def parse_facebook_page_ids(parties: List[str]) -> dict[str, List[str]]:
@@ -78,36 +269,44 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("-a", "--all", action="store_true")
     parser.add_argument("-p", "--parties")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DOWNLOAD_JOBS,
+        help="The number of requests (or shards with --replay) that are processed concurrently.",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="Append the raw responses to the response archive.",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Parse the ads in the response archive instead of requesting them.",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Profile the run with cProfile and write the statistics to PATH.",
+    )
 
     args = parser.parse_args()
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    if args.parties:
-        page_ids_per_party = parse_facebook_page_ids(
-            [p for p in args.parties.split(",") if p in PARTIES]
-        )
-    else:
-        page_ids_per_party = parse_facebook_page_ids(PARTIES)
+    parties = (
+        [p for p in args.parties.split(",") if p in PARTIES]
+        if args.parties
+        else PARTIES
+    )
 
-    for party, page_ids in page_ids_per_party.items():
+    with instrumented_run("download", args.profile):
+        create_tables()
 
-        for i in range(0, len(page_ids), MAX_PAGE_IDS_PER_REQUEST):
-            page_ids_subset = page_ids[i : i + MAX_PAGE_IDS_PER_REQUEST]
-
-            logging.info(
-                f"Downloading ads of {len(page_ids_subset)}"
-                f" pages ({i}/{len(page_ids)}) ({party})"
-            )
-
-            download_ads(
-                FACEBOOK_API_URL.format(
-                    page_ids=",".join(page_ids_subset),
-                    min_date=(date.today() - timedelta(weeks=1)).strftime(
-                        DATETIME_FORMAT
-                    )
-                    if not args.all
-                    else FIRST_DATE.strftime(DATETIME_FORMAT),
-                ),
-                party,
-            )
+        if args.replay:
+            replay_archive(parties, args.jobs)
+        else:
+            min_date = date.today() - timedelta(weeks=1) if not args.all else FIRST_DATE
+            download_all(parties, min_date, args.jobs, args.archive)
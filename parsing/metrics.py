@@ -0,0 +1,106 @@
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional
+
+from constants import RUN_SUMMARY_PATH
+
+# Serializes updates from the download threads.
+METRICS_LOCK = threading.Lock()
+
+# The total seconds and number of calls of every timer, and the value of every counter.
+TIMERS: Dict[str, Dict[str, float]] = defaultdict(lambda: {"seconds": 0.0, "count": 0})
+COUNTERS: Dict[str, int] = defaultdict(int)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    """Add the time spent in a block to a timer, and count the block."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with METRICS_LOCK:
+            TIMERS[name]["seconds"] += seconds
+            TIMERS[name]["count"] += 1
+
+
+def count(name: str, value: int = 1) -> None:
+    """Add a value to a counter."""
+    with METRICS_LOCK:
+        COUNTERS[name] += value
+
+
+def counted_bytes(name: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Yield chunks, and add their length to a counter."""
+    for chunk in chunks:
+        count(name, len(chunk))
+        yield chunk
+
+
+def summary() -> dict:
+    """Return the timers and counters that were recorded in this process."""
+    with METRICS_LOCK:
+        return {
+            "timers": {name: dict(values) for name, values in sorted(TIMERS.items())},
+            "counters": dict(sorted(COUNTERS.items())),
+        }
+
+
+@contextmanager
+def instrumented_run(script: str, profile_path: Optional[str] = None) -> Iterator[None]:
+    """
+    Record a summary of a run of a script, and optionally profile it.
+
+    When the run ends (also when it fails), a JSON object with its duration,
+    timers and counters is appended to RUN_SUMMARY_PATH. Timers and counters of
+    worker processes are not included, the time spent waiting on them is.
+
+    :param script: The name of the script.
+    :param profile_path: If given, the run is profiled with cProfile and the
+    statistics are written to this path (read them with pstats or e.g. snakeviz).
+    Only the main thread is profiled.
+    """
+    profiler = cProfile.Profile() if profile_path else None
+    started = datetime.now()
+    start = time.perf_counter()
+    succeeded = False
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+        succeeded = True
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            logging.info(f"Wrote profile to {profile_path}.")
+
+        run_summary = {
+            "script": script,
+            "arguments": sys.argv[1:],
+            "started": started.isoformat(timespec="seconds"),
+            "seconds": time.perf_counter() - start,
+            "succeeded": succeeded,
+        } | summary()
+
+        os.makedirs(os.path.dirname(RUN_SUMMARY_PATH), exist_ok=True)
+        with open(RUN_SUMMARY_PATH, "a") as h_summary:
+            h_summary.write(json.dumps(run_summary) + "\n")
+
+        logging.info(
+            f"Run took {run_summary['seconds']:.1f}s: "
+            + ", ".join(
+                f"{name} {values['seconds']:.1f}s"
+                for name, values in run_summary["timers"].items()
+            )
+        )
@@ -0,0 +1,25 @@
+import argparse
+import logging
+
+from models import migrate_archive, needs_migration
+
+logging.basicConfig(
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Convert an archive with an older layout. This rewrites the whole archive."
+    )
+    parser.parse_args()
+
+    if not needs_migration():
+        logging.info("The archive does not need to be converted.")
+    else:
+        logging.info("Converting the archive.")
+        migrate_archive()
+        logging.info("Converted the archive.")
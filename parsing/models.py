@@ -1,23 +1,76 @@
 import re
+import struct
 import typing
+from collections import Counter
 from datetime import date
 from functools import cached_property
 
 from peewee import (
+    BlobField,
+    Cast,
     CharField,
     DateField,
-    FloatField,
     IntegerField,
     Model,
+    ModelSelect,
     SqliteDatabase,
     TextField,
+    Value,
+    chunked,
+    fn,
 )
 
-from constants import AGE_RANGES, FIRST_DATE, GENDERS, LOCAL_AD_ARCHIVE_PATH, REGIONS
+from constants import (
+    AGE_RANGES,
+    DATABASE_PRAGMAS,
+    DATABASE_TIMEOUT_SECONDS,
+    DEMOGRAPHICS,
+    FIRST_DATE,
+    GENDERS,
+    LOCAL_AD_ARCHIVE_PATH,
+    READ_ONLY_DATABASE_PRAGMAS,
+    REGIONS,
+    UNCLASSIFIED_THEMES,
+)
+from playhouse.migrate import SqliteMigrator, migrate
+
+from themes import Theme
 
 PATTERN_NON_WORD_CHARS = re.compile(r"[^a-zA-Z0-9-' #]")
 
-database_handler = SqliteDatabase(LOCAL_AD_ARCHIVE_PATH)
+# The Julian day of date.fromordinal(1) is 1721425.5.
+JULIAN_DAY_OF_ORDINAL_ZERO = 1721424.5
+
+# The layout of Ad.demographics: a float32 for every demographic except total.
+DEMOGRAPHICS_STRUCT = struct.Struct(f"<{len(DEMOGRAPHICS) - 1}f")
+
+database_handler = SqliteDatabase(
+    LOCAL_AD_ARCHIVE_PATH, pragmas=DATABASE_PRAGMAS, timeout=DATABASE_TIMEOUT_SECONDS
+)
+
+
+def use_read_only_database() -> None:
+    """
+    Reopen the archive read-only, e.g. for the processing scripts.
+
+    Read-only connections never take write locks, so the processing scripts can
+    run while download.py writes to the archive.
+    """
+    database_handler.close()
+    database_handler.init(
+        f"file:{LOCAL_AD_ARCHIVE_PATH}?mode=ro",
+        uri=True,
+        pragmas=READ_ONLY_DATABASE_PRAGMAS,
+        timeout=DATABASE_TIMEOUT_SECONDS,
+    )
+    require_current_layout()
+
+
+def _date_to_ordinal(field: DateField) -> Cast:
+    """Convert a date in SQL to the same ordinal as date.toordinal."""
+    return Cast(
+        fn.julianday(field).coerce(False) - JULIAN_DAY_OF_ORDINAL_ZERO, "INTEGER"
+    )
 
 
 class Ad(Model):
@@ -27,6 +80,12 @@ class Ad(Model):
         """Meta class for Ad model."""
 
         database = database_handler
+        indexes = (
+            (("party", "start_date"), False),
+            (("party", "end_date", "start_date"), False),
+            (("start_date",), False),
+            (("end_date", "start_date"), False),
+        )
 
     ad_id = CharField(unique=True)
     page_id = CharField()
@@ -52,18 +111,74 @@ class Ad(Model):
     audience_size_lower = IntegerField()
     audience_size_upper = IntegerField()
 
+    # The fractions of DEMOGRAPHICS[1:], packed by pack_demographics, or null if the ad has no demographic data.
+    demographics = BlobField(null=True)
+
     @classmethod
-    def ads_in_time_range(cls, first_date=FIRST_DATE, last_date=date.today()):
+    def ads_in_time_range(
+        cls,
+        first_date=FIRST_DATE,
+        last_date=date.today(),
+        party: typing.Optional[str] = None,
+    ):
         """
         Return a query that contains all ads that were active in a certain time period (i.e. between first_date and last_date).
 
-        Ads that are considered active between first_date and last_date meet at least one of the following constraints:
-        - Ad.start_date falls between first_date and last_date.
-        - Ad.end_end falls between first_date and last_date.
+        Ads that are considered active between first_date and last_date meet both of the following constraints:
+        - Ad.start_date falls on or before last_date.
+        - Ad.end_date falls on or after first_date, or the ad is still active (i.e. Ad.end_date is null).
+
+        SQLite cannot look up the OR in an index, so the ads that ended and the ads that are still
+        active are selected separately: both are a range in the (end_date, start_date) index, which
+        means only the ads that end after first_date are examined instead of every ad. With a party,
+        they are ranges in the (party, end_date, start_date) index instead.
+
+        :param party: If given, only the ads of this party.
+        """
+        ended = Ad.select(Ad.id).where(
+            (Ad.end_date >= first_date) & (Ad.start_date <= last_date)
+        )
+        active = Ad.select(Ad.id).where(
+            Ad.end_date.is_null() & (Ad.start_date <= last_date)
+        )
+        if party is not None:
+            ended = ended.where(Ad.party == party)
+            active = active.where(Ad.party == party)
+
+        return Ad.select().where(Ad.id.in_(ended + active))
+
+    @classmethod
+    def analysis_view(
+        cls, query: typing.Optional[ModelSelect] = None
+    ) -> typing.Iterable[tuple]:
         """
-        return Ad.select().where(
-            (first_date <= Ad.start_date) & (Ad.start_date <= last_date)
-            | (first_date <= Ad.end_date) & (Ad.end_date <= last_date)
+        Return the values of ads that are needed to aggregate them, as tuples instead of Ad instances.
+
+        Every tuple contains (in order) ad_id, party, start_date and end_date as ordinals
+        (see date.toordinal, end_date is 0 if the ad is still active), themes, the
+        lower and upper bounds of spending, impressions and audience size, and demographics.
+        The rows come straight from the SQLite cursor, so peewee does not convert
+        every value, and computing the ordinals in SQL means no date objects are created.
+
+        :param query: A query of ads (e.g. Ad.ads_in_time_range), defaults to all ads.
+        :return: A cursor that yields tuples.
+        """
+        query = query if query is not None else cls.select()
+        return cls._meta.database.execute(
+            query.select(
+                cls.ad_id,
+                cls.party,
+                _date_to_ordinal(cls.start_date),
+                fn.COALESCE(_date_to_ordinal(cls.end_date), 0),
+                cls.themes,
+                cls.spending_lower,
+                cls.spending_upper,
+                cls.impressions_lower,
+                cls.impressions_upper,
+                cls.audience_size_lower,
+                cls.audience_size_upper,
+                cls.demographics,
+            )
         )
 
     @cached_property
@@ -120,9 +235,7 @@ class Ad(Model):
     ) -> typing.Generator[int, None, None]:
         """Yield the indices of dates that this ad was active during a time range."""
         ad_end_date = self.end_date or date.today()
-        if (first_date <= self.start_date <= last_date) or (
-            first_date <= ad_end_date <= last_date
-        ):
+        if self.start_date <= last_date and ad_end_date >= first_date:
 
             if self.start_date < first_date:
                 ad_start_date = first_date
@@ -137,10 +250,31 @@ class Ad(Model):
             for date_offset in range(days_active_in_range):
                 yield start_date_index + date_offset
 
+    @staticmethod
+    def pack_demographics(fractions: typing.Sequence[float]) -> typing.Optional[bytes]:
+        """
+        Pack the fractions of DEMOGRAPHICS[1:] into a value of Ad.demographics.
+
+        :param fractions: A fraction for every demographic, in the order of DEMOGRAPHICS[1:].
+        :return: The fractions as little-endian float32, or None if all fractions are 0.
+        """
+        if not any(fractions):
+            return None
+
+        return DEMOGRAPHICS_STRUCT.pack(*fractions)
+
+    @cached_property
+    def demographic_fractions(self) -> typing.Tuple[float, ...]:
+        """Return the fractions of DEMOGRAPHICS[1:] for this ad."""
+        if self.demographics is None:
+            return (0.0,) * (len(DEMOGRAPHICS) - 1)
+
+        return DEMOGRAPHICS_STRUCT.unpack(self.demographics)
+
     @staticmethod
     def demographic_to_field_name(demographic: str) -> str:
         """
-        Map demographics (e.g. male or 65+) to field names of the Ad model.
+        Map demographics (e.g. male or 65+) to the field names that older archives stored them in.
 
         :param demographic: A string (e.g. male or 65+).
         :return: A field name.
@@ -183,10 +317,296 @@ class Ad(Model):
         if demographic == "total":
             return amount
 
-        return amount * getattr(self, Ad.demographic_to_field_name(demographic))
+        return amount * self.demographic_fractions[DEMOGRAPHICS.index(demographic) - 1]
+
+
+class DirtyAd(Model):
+    """Model representing an ad that was inserted or replaced since the last aggregation."""
+
+    class Meta:
+        """Meta class for DirtyAd model."""
+
+        database = database_handler
+
+    ad_id = CharField(unique=True)
+
+    @classmethod
+    def mark(cls, ad_ids: typing.Iterable[str]) -> None:
+        """
+        Mark ads as changed, so their daily aggregates are recomputed.
+
+        Marking an ad again gives it a new id, so it is not lost by a refresh
+        that started before it was marked again.
+        """
+        cls.insert_many(
+            [{"ad_id": ad_id} for ad_id in ad_ids]
+        ).on_conflict_replace().execute()
+
+    @classmethod
+    def clear(cls, last_id: typing.Optional[int]) -> None:
+        """
+        Unmark the ads that were marked up to last_id, e.g. after their aggregates were saved.
+
+        :param last_id: The id of the last mark to remove, nothing is removed if it is None.
+        """
+        if last_id is not None:
+            cls.delete().where(cls.id <= last_id).execute()
+
+
+class ThemeCache(Model):
+    """Model representing the lemmas and themes of a parsed ad text."""
+
+    class Meta:
+        """Meta class for ThemeCache model."""
+
+        database = database_handler
+
+    # A hash of the parsed text and the version of the spaCy model that parsed it.
+    content_hash = CharField(unique=True)
+    model_version = CharField()
+
+    # A JSON list of the lemmas that are used to classify themes.
+    lemmas = TextField()
+
+    themes = IntegerField()
+    # The themes are stale if the wordlists changed, but the lemmas are not.
+    wordlist_version = CharField()
+
+
+class AdTheme(Model):
+    """Model representing that an ad matches a theme, so ads can be looked up by theme."""
+
+    class Meta:
+        """Meta class for AdTheme model."""
+
+        database = database_handler
+        indexes = ((("theme", "ad_id"), True),)
+
+    ad_id = CharField(index=True)
+    theme = IntegerField()
+
+    @classmethod
+    def ad_ids(cls, theme_value: int) -> ModelSelect:
+        """Return a subquery of the ids of the ads that match a theme (e.g. for Ad.ad_id.in_)."""
+        return cls.select(cls.ad_id).where(cls.theme == theme_value)
+
+    @classmethod
+    def set_themes(cls, ad_themes: typing.Dict[str, int]) -> None:
+        """
+        Replace the themes of ads.
+
+        :param ad_themes: A dict that maps ad ids to the flags of their themes.
+        """
+        for ad_ids in chunked(ad_themes, 500):
+            cls.delete().where(cls.ad_id.in_(ad_ids)).execute()
+
+        rows = [
+            {"ad_id": ad_id, "theme": theme.value}
+            for ad_id, flags in ad_themes.items()
+            if flags != UNCLASSIFIED_THEMES
+            for theme in Theme.all()
+            if flags & theme.value
+        ]
+        for rows_batch in chunked(rows, 500):
+            cls.insert_many(rows_batch).execute()
+
+    @classmethod
+    def rebuild(cls) -> None:
+        """Recreate the themes of all ads from Ad.themes."""
+        cls.delete().execute()
+        for theme in Theme.all():
+            cls.insert_from(
+                Ad.select(Ad.ad_id, Value(theme.value)).where(
+                    (Ad.themes != UNCLASSIFIED_THEMES)
+                    & (Ad.themes.bin_and(theme.value) != 0)
+                ),
+                [cls.ad_id, cls.theme],
+            ).execute()
+
+
+class AdLemma(Model):
+    """
+    Model representing how often a lemma occurs in an ad.
+
+    The lemmas of an ad are those that its themes are classified with (see
+    parsing.doc_to_lemmas), so they are an inverted index from lemmas to ads.
+    """
+
+    class Meta:
+        """Meta class for AdLemma model."""
+
+        database = database_handler
+        indexes = ((("lemma", "ad_id"), True),)
+
+    ad_id = CharField(index=True)
+    lemma = CharField()
+    occurrences = IntegerField()
+
+    @classmethod
+    def ad_ids(cls, lemmas: typing.Iterable[str]) -> ModelSelect:
+        """Return a subquery of the ids of the ads that contain any of the lemmas (e.g. for Ad.ad_id.in_)."""
+        return cls.select(cls.ad_id).where(cls.lemma.in_(list(lemmas))).distinct()
+
+    @classmethod
+    def lemmas(cls, ad_ids: typing.Iterable[str]) -> typing.Dict[str, typing.List[str]]:
+        """Return a dict that maps ad ids to their lemmas, in no particular order."""
+        ad_lemmas = {}
+        for ad_ids_batch in chunked(ad_ids, 500):
+            for ad_id, lemma, occurrences in (
+                cls.select(cls.ad_id, cls.lemma, cls.occurrences)
+                .where(cls.ad_id.in_(ad_ids_batch))
+                .tuples()
+            ):
+                ad_lemmas.setdefault(ad_id, []).extend([lemma] * occurrences)
+
+        return ad_lemmas
+
+    @classmethod
+    def set_lemmas(cls, ad_lemmas: typing.Dict[str, typing.List[str]]) -> None:
+        """
+        Replace the lemmas of ads.
+
+        :param ad_lemmas: A dict that maps ad ids to their lemmas.
+        """
+        for ad_ids in chunked(ad_lemmas, 500):
+            cls.delete().where(cls.ad_id.in_(ad_ids)).execute()
+
+        # Ads have dozens of lemmas, which are too many rows to insert through queries of peewee.
+        cls._meta.database.cursor().executemany(
+            f"INSERT INTO {cls._meta.table_name} (ad_id, lemma, occurrences) VALUES (?, ?, ?)",
+            (
+                (ad_id, lemma, occurrences)
+                for ad_id, lemmas in ad_lemmas.items()
+                for lemma, occurrences in Counter(lemmas).items()
+            ),
+        )
+
+
+class ThemeWord(Model):
+    """Model representing a word of the wordlist of a theme, as it was when the themes of the ads were classified."""
+
+    class Meta:
+        """Meta class for ThemeWord model."""
+
+        database = database_handler
+
+    theme = IntegerField()
+    word = CharField()
+
+    @staticmethod
+    def _current_words() -> typing.Set[typing.Tuple[int, str]]:
+        return {(theme.value, word) for theme in Theme.all() for word in theme.wordlist}
+
+    @classmethod
+    def changed_words(cls) -> typing.Set[str]:
+        """Return the words that were added to or removed from a wordlist since the wordlists were stored."""
+        stored_words = set(cls.select(cls.theme, cls.word).tuples())
+        return {word for _, word in stored_words ^ cls._current_words()}
+
+    @classmethod
+    def store(cls) -> None:
+        """Replace the stored wordlists with the current wordlists."""
+        cls.delete().execute()
+        for rows_batch in chunked(cls._current_words(), 500):
+            cls.insert_many(rows_batch, fields=[cls.theme, cls.word]).execute()
+
+
+class ThemeClassifier(Model):
+    """Model representing how the themes of the classified ads were classified, it has at most one row."""
+
+    class Meta:
+        """Meta class for ThemeClassifier model."""
+
+        database = database_handler
+
+    # Themes are classified by matching lemmas with the wordlists, or by the similarity of their word vectors.
+    WORDLISTS = "wordlists"
+    VECTORS = "vectors"
+
+    name = CharField()
+
+    @classmethod
+    def current(cls) -> str:
+        """Return how the themes of the ads are classified, archives without a row are classified by wordlists."""
+        row = cls.select(cls.name).first()
+        return row.name if row is not None else cls.WORDLISTS
+
+    @classmethod
+    def store(cls, name: str) -> None:
+        """Replace how the themes of the ads are classified."""
+        cls.delete().execute()
+        cls.create(name=name)
+
+
+MODELS = [Ad, DirtyAd, ThemeCache, AdTheme, AdLemma, ThemeWord, ThemeClassifier]
+
+
+def needs_migration() -> bool:
+    """
+    Return whether the archive has an older layout, which migrate.py converts.
+
+    Older archives store the demographics of ads in separate columns, or do not
+    have the AdTheme table yet.
+    """
+    if not Ad.table_exists():
+        return False
+
+    column_names = {c.name for c in database_handler.get_columns(Ad._meta.table_name)}
+    return "demographics" not in column_names or not AdTheme.table_exists()
+
+
+def require_current_layout() -> None:
+    """Raise an error if the archive has to be converted by migrate.py before it can be used."""
+    if needs_migration():
+        raise RuntimeError(
+            "The archive has an older layout, convert it with migrate.py first."
+        )
+
+
+def create_tables() -> None:
+    """
+    Create the tables and indexes that do not exist yet, e.g. before writing to the archive.
+
+    Archives with an older layout are not changed, see require_current_layout.
+    """
+    require_current_layout()
+    database_handler.create_tables(MODELS)
+
+
+def migrate_demographic_columns() -> None:
+    """
+    Pack the demographic columns of older archives into Ad.demographics and drop them.
+
+    This rewrites the whole archive.
+    """
+    column_names = [Ad.demographic_to_field_name(d) for d in DEMOGRAPHICS[1:]]
+    if column_names[0] not in {c.name for c in database_handler.get_columns("ad")}:
+        return
+
+    migrator = SqliteMigrator(database_handler)
+    with database_handler.atomic():
+        migrate(migrator.add_column("ad", "demographics", Ad.demographics))
+
+        rows = database_handler.execute_sql(
+            f"SELECT id, {', '.join(column_names)} FROM ad"
+        ).fetchall()
+        database_handler.cursor().executemany(
+            "UPDATE ad SET demographics = ? WHERE id = ?",
+            [(Ad.pack_demographics(row[1:]), row[0]) for row in rows],
+        )
+
+        migrate(*[migrator.drop_column("ad", name) for name in column_names])
+
+    # Reclaim the space of the dropped columns.
+    database_handler.execute_sql("VACUUM")
 
 
-for dt in GENDERS + REGIONS + AGE_RANGES:
-    Ad._meta.add_field(Ad.demographic_to_field_name(dt), FloatField(default=0))
+def migrate_archive() -> None:
+    """Convert an archive with an older layout, and create the tables and indexes that do not exist yet."""
+    ad_theme_table_exists = AdTheme.table_exists()
+    if Ad.table_exists():
+        migrate_demographic_columns()
 
-database_handler.create_tables([Ad])
+    database_handler.create_tables(MODELS)
+    if not ad_theme_table_exists:
+        AdTheme.rebuild()
@@ -1,29 +1,49 @@
+import codecs
+import json
 import logging
-from datetime import datetime
-from decimal import Decimal
-from typing import Optional, Tuple
-
-import spacy
-
-from unidecode import unidecode
+from datetime import date
+from functools import cache
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, List, Optional, Tuple
 
 from constants import (
     AGE_RANGES,
     CURRENCY_EXCHANGE_RATE_MAP,
-    DATETIME_FORMAT,
+    DEMOGRAPHICS,
     GENDER_IGNORE_LIST,
     GENDERS,
+    NLP_DISABLED_COMPONENTS,
+    NLP_MODEL,
     REGION_IGNORE_LIST,
     REGIONS,
+    UNCLASSIFIED_THEMES,
 )
 from models import Ad
-from themes import Theme
+from themes import Theme, theme_matcher
+
+# Map the demographics in API responses to their index in Ad.demographics.
+GENDER_AGE_INDICES = {
+    demographic: DEMOGRAPHICS.index(demographic) - 1
+    for demographic in GENDERS + AGE_RANGES
+}
+REGION_INDICES = {region: DEMOGRAPHICS.index(region) - 1 for region in REGIONS} | {
+    "North Brabant": DEMOGRAPHICS.index("Noord-Brabant") - 1
+}
+
+if TYPE_CHECKING:
+    from spacy.language import Language
+    from spacy.tokens import Doc
+
+
+@cache
+def nlp() -> "Language":
+    """Return the (cached) spaCy model, which is only loaded when it is first used."""
+    import spacy
 
-NLP = spacy.load("nl_core_news_lg")
+    return spacy.load(NLP_MODEL, disable=NLP_DISABLED_COMPONENTS)
 
 
-def _parse_date(data: dict, key: str) -> Optional[datetime]:
-    return datetime.strptime(data[key], DATETIME_FORMAT) if key in data else None
+def _parse_date(data: dict, key: str) -> Optional[date]:
+    return date.fromisoformat(data[key]) if key in data else None
 
 
 def _parse_estimated_value(data: dict, key: str) -> Tuple[int, int]:
@@ -49,12 +69,25 @@ def _parse_content(data: dict, key: str):
     )
 
 
-def _parse_themes(ad_content: str) -> int:
+def ad_content(ad: dict) -> str:
+    """Return the text of an ad that is used to classify its themes."""
+    return " ".join(
+        [
+            ad["creative_bodies"],
+            ad["creative_link_descriptions"],
+            ad["creative_link_titles"],
+        ]
+    )
+
 
-    doc = NLP(unidecode(ad_content))
-    words = [t.lemma_ for t in doc if t.pos_ in ("NOUN", "ADJ", "PROPN")]
+def doc_to_lemmas(doc: "Doc") -> List[str]:
+    """Return the lemmas of the words in a parsed ad that are used to classify its themes."""
+    return [t.lemma_ for t in doc if t.pos_ in ("NOUN", "ADJ", "PROPN")]
 
-    theme_intersections = Theme.intersections(words)
+
+def lemmas_to_themes(words: List[str]) -> int:
+    """Return the flags of the themes that match the lemmas of an ad."""
+    theme_intersections = theme_matcher().intersections(words)
 
     if not theme_intersections:
         return Theme.NONE.value
@@ -75,6 +108,9 @@ def json_to_ad_dict(ad_json_data: dict, party: str) -> dict:
     """
     Transform a json object into an dictionary that corresponds with the Ad model.
 
+    The themes of the ad are not classified, see classify.py.
+    Every dict has the same fields, the demographics are packed into one field.
+
     :param ad_json_data: Json object representing an ad from the Facebook API.
     :param party: Current party to parse.
     :return: A dict corresponds with the Ad model.
@@ -111,6 +147,7 @@ def json_to_ad_dict(ad_json_data: dict, party: str) -> dict:
         "impressions_upper": impressions_upper,
         "audience_size_lower": audience_size_lower,
         "audience_size_upper": audience_size_upper,
+        "themes": UNCLASSIFIED_THEMES,
     }
 
     if "languages" in ad_json_data and ad_json_data["languages"] != ["nl"]:
@@ -119,45 +156,142 @@ def json_to_ad_dict(ad_json_data: dict, party: str) -> dict:
             f"({ad_dict['ad_id']}): {','.join(ad_json_data['languages'])}"
         )
 
+    fractions = [0.0] * (len(DEMOGRAPHICS) - 1)
+
     if "delivery_by_region" in ad_json_data:
         for distribution in ad_json_data["delivery_by_region"]:
             region = distribution["region"]
-            percentage = Decimal(distribution["percentage"])
-            if region == "North Brabant":
-                region = "Noord-Brabant"
-
-            if region in REGIONS:
-                field_name = Ad.demographic_to_field_name(region)
-                ad_dict[field_name] = percentage
-            else:
-                if region not in REGION_IGNORE_LIST:
-                    logging.warning(f"Unknown region: {region} ({ad_dict['ad_id']})")
+            index = REGION_INDICES.get(region)
+            if index is not None:
+                fractions[index] = float(distribution["percentage"])
+            elif region not in REGION_IGNORE_LIST:
+                logging.warning(f"Unknown region: {region} ({ad_dict['ad_id']})")
 
     if "demographic_distribution" in ad_json_data:
         for distribution in ad_json_data["demographic_distribution"]:
-            percentage = Decimal(distribution["percentage"])
+            percentage = float(distribution["percentage"])
             for demographic in (distribution["gender"], distribution["age"]):
-                if demographic in GENDERS or demographic in AGE_RANGES:
-                    field_name = Ad.demographic_to_field_name(demographic)
-                    if field_name not in ad_dict:
-                        ad_dict[field_name] = percentage
-                    else:
-                        ad_dict[field_name] += percentage
-                else:
-                    if demographic not in GENDER_IGNORE_LIST:
-                        logging.warning(
-                            f"Unknown gender/age group: "
-                            f"{demographic} ({ad_dict['ad_id']})"
-                        )
-
-    ad_dict["themes"] = _parse_themes(
-        " ".join(
-            [
-                ad_dict["creative_bodies"],
-                ad_dict["creative_link_descriptions"],
-                ad_dict["creative_link_titles"],
-            ]
-        )
-    )
+                index = GENDER_AGE_INDICES.get(demographic)
+                if index is not None:
+                    fractions[index] += percentage
+                elif demographic not in GENDER_IGNORE_LIST:
+                    logging.warning(
+                        f"Unknown gender/age group: "
+                        f"{demographic} ({ad_dict['ad_id']})"
+                    )
 
+    ad_dict["demographics"] = Ad.pack_demographics(fractions)
     return ad_dict
+
+
+class AdStream:
+    """
+    Incrementally parse a response of the Facebook Ad Library API.
+
+    Iterating over the stream yields the ads in the data array as soon as they
+    are received, so a page never has to be held in memory completely. The other
+    members of the response (paging or error) are available after iterating.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        """
+        Create a stream from chunks of a response body.
+
+        :param chunks: Chunks of the body, e.g. from requests.Response.iter_content.
+        """
+        self.paging = {}
+        self.error = None
+
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._position = 0
+
+    def _read(self) -> bool:
+        """Append the next chunk to the buffer, or return False if there are no chunks left."""
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+
+        # Drop everything that has been parsed, so the buffer stays small.
+        self._buffer = self._buffer[self._position :] + self._decoder.decode(chunk)
+        self._position = 0
+        return True
+
+    def _peek(self) -> str:
+        """Skip whitespace and return the next character without consuming it."""
+        while True:
+            while (
+                self._position < len(self._buffer)
+                and self._buffer[self._position].isspace()
+            ):
+                self._position += 1
+
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+
+            if not self._read():
+                raise ValueError("Unexpected end of response.")
+
+    def _expect(self, characters: str) -> str:
+        """Consume the next character, which must be one of the given characters."""
+        character = self._peek()
+        if character not in characters:
+            raise ValueError(f"Expected one of '{characters}', got '{character}'.")
+
+        self._position += 1
+        return character
+
+    def _decode(self) -> Any:
+        """Decode the next JSON value, reading chunks until it is complete."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+                continue
+
+            # A number that ends with the buffer can continue in the next chunk.
+            if (
+                end == len(self._buffer)
+                and isinstance(value, (int, float))
+                and not isinstance(value, bool)
+                and self._read()
+            ):
+                continue
+
+            self._position = end
+            return value
+
+    def __iter__(self) -> Iterator[dict]:
+        """Yield the ads in the data array of the response."""
+        self._expect("{")
+        if self._peek() == "}":
+            return
+
+        while True:
+            key = self._decode()
+            self._expect(":")
+
+            if key == "data":
+                self._expect("[")
+                if self._peek() == "]":
+                    self._position += 1
+                else:
+                    while True:
+                        yield self._decode()
+                        if self._expect(",]") == "]":
+                            break
+
+            elif key == "paging":
+                self.paging = self._decode()
+            elif key == "error":
+                self.error = self._decode()
+            else:
+                self._decode()
+
+            if self._expect(",}") == "}":
+                return
@@ -1,10 +1,9 @@
+import argparse
 import logging
-from datetime import date
 
-from constants import DEMOGRAPHIC_TYPE_TO_LIST_MAP, DEMOGRAPHIC_TYPES, PARTIES
-from models import Ad
-from themes import Theme
-from utils import recursive_round, render_template
+from metrics import instrumented_run
+from models import use_read_only_database
+from processing import create_theme_data, load_ads, render_themes_page
 
 logging.basicConfig(
     format="[%(asctime)s] %(levelname)s: %(message)s",
@@ -12,69 +11,20 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-SEPT_1 = date(year=2020, month=9, day=1)
-
 if __name__ == "__main__":
 
-    theme_data = {
-        "impressions-demographics-theme": {
-            t: {dt: [] for dt in DEMOGRAPHIC_TYPES} for t in Theme.titles()
-        },
-        "impressions-demographics-theme-party": {
-            p: {t: {dt: [] for dt in DEMOGRAPHIC_TYPES} for t in Theme.titles()}
-            for p in PARTIES
-        },
-        "impressions-theme-party": {p: [] for p in PARTIES},
-        "number-of-ads-theme-party": {p: [] for p in PARTIES},
-        "matched": {
-            p: [
-                Ad.ads_in_time_range(first_date=SEPT_1)
-                .where(Ad.themes != 0)
-                .where(Ad.party == p)
-                .count(),
-                Ad.ads_in_time_range(first_date=SEPT_1)
-                .where(Ad.themes == 0)
-                .where(Ad.party == p)
-                .count(),
-            ]
-            for p in PARTIES
-        },
-    }
-
-    for theme in Theme.all():
-        logging.info(f"Processing {theme.title}.")
-
-        ads = Ad.ads_in_time_range(first_date=SEPT_1).where(
-            Ad.themes.bin_and(theme.value) == theme.value
-        )
-        for demographic_type in DEMOGRAPHIC_TYPES:
-            for demographic in DEMOGRAPHIC_TYPE_TO_LIST_MAP[demographic_type]:
-                theme_data["impressions-demographics-theme"][theme.title][
-                    demographic_type
-                ].append(sum(a.rank_to_data("impressions", demographic) for a in ads))
-
-        for party in PARTIES:
-            ads = (
-                Ad.ads_in_time_range(first_date=SEPT_1)
-                .where(Ad.party == party)
-                .where(Ad.themes.bin_and(theme.value) == theme.value)
-            )
-
-            theme_data["number-of-ads-theme-party"][party].append(ads.count())
-            theme_data["impressions-theme-party"][party].append(
-                sum(a.rank_to_data("impressions", "total") for a in ads)
-            )
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Profile the run with cProfile and write the statistics to PATH.",
+    )
+    args = parser.parse_args()
 
-            for demographic_type in DEMOGRAPHIC_TYPES:
-                for demographic in DEMOGRAPHIC_TYPE_TO_LIST_MAP[demographic_type]:
-                    theme_data["impressions-demographics-theme-party"][party][
-                        theme.title
-                    ][demographic_type].append(
-                        sum(a.rank_to_data("impressions", demographic) for a in ads)
-                    )
+    with instrumented_run("processing-themes", args.profile):
+        use_read_only_database()
+        ads = load_ads()
+        theme_data = create_theme_data(ads)
 
-    logging.debug("Writing templates.")
-    recursive_round(theme_data)
-    render_template(
-        "themes.html", "themes.html", theme_data=theme_data, THEMES=Theme.titles()
-    )
+        logging.debug("Writing templates.")
+        render_themes_page(theme_data)
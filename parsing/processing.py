@@ -0,0 +1,339 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from functools import cache
+from itertools import repeat
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from aggregates import DailyAggregateStore
+from aggregation import AdColumns
+from constants import (
+    DATA_TYPE_PRECISIONS,
+    DATA_TYPES,
+    DEMOGRAPHIC_TYPE_TO_LIST_MAP,
+    DEMOGRAPHIC_TYPES,
+    DEMOGRAPHICS,
+    PARTIES,
+    PARTY_PAGE_DATA_TYPES,
+    UNCLASSIFIED_THEMES,
+)
+from metrics import count, timer
+from models import Ad, DirtyAd, database_handler, use_read_only_database
+from themes import Theme
+from utils import render_template, round_values, write_chart_data
+
+SEPT_1 = date(year=2020, month=9, day=1)
+
+# The daily series that are written to the chart data files, and their precision.
+GENERAL_DAILY_SCHEMA = {
+    f"{data_type}-party-daily": DATA_TYPE_PRECISIONS[data_type]
+    for data_type in DATA_TYPES
+}
+PARTY_DAILY_SCHEMA = {
+    f"{data_type}-{demographic_type}-daily": DATA_TYPE_PRECISIONS[data_type]
+    for data_type in PARTY_PAGE_DATA_TYPES
+    for demographic_type in DEMOGRAPHIC_TYPES
+    if demographic_type != "total"
+}
+
+
+def load_ads() -> AdColumns:
+    """Load all ads that were active since SEPT_1 into column arrays."""
+    unclassified_ads = Ad.select().where(Ad.themes == UNCLASSIFIED_THEMES).count()
+    if unclassified_ads > 0:
+        logging.warning(
+            f"The themes of {unclassified_ads} ads are not classified, run classify.py."
+        )
+
+    ads = _query_ads()
+    count("ads-loaded", len(ads))
+    return ads
+
+
+@timer("ad-loading")
+def _query_ads(party: Optional[str] = None) -> AdColumns:
+    return AdColumns.from_query(
+        Ad.ads_in_time_range(first_date=SEPT_1, party=party), first_date=SEPT_1
+    )
+
+
+@cache
+def _worker_daily_aggregates() -> DailyAggregateStore:
+    """Return the daily aggregates of a worker process, which the parent process brought up to date."""
+    return DailyAggregateStore.load()
+
+
+def _create_worker_pool(jobs: int) -> ProcessPoolExecutor:
+    """
+    Create a pool of worker processes that open the archive read-only.
+
+    The connection of the parent process is closed first, so it is not shared
+    with the workers. It is reopened when the parent process uses it again.
+    """
+    database_handler.close()
+    return ProcessPoolExecutor(max_workers=jobs, initializer=use_read_only_database)
+
+
+@timer("daily-aggregates")
+def load_daily_aggregates() -> DailyAggregateStore:
+    """Load the daily aggregates and bring them up to date, or build them if they do not exist."""
+    daily_aggregates = DailyAggregateStore.load()
+    if daily_aggregates is None or daily_aggregates.first_date != SEPT_1:
+        logging.info("Building daily aggregates.")
+        daily_aggregates, last_dirty_id = DailyAggregateStore.build(SEPT_1)
+    else:
+        last_dirty_id = daily_aggregates.refresh()
+
+    # The marks of changed ads are only removed once the store that includes them is saved.
+    daily_aggregates.save()
+    DirtyAd.clear(last_dirty_id)
+    return daily_aggregates
+
+
+def _party_totals(ads_per_party: dict, data_type: str) -> list:
+    """Return the rounded total amount of a data type of every party."""
+    return round_values(
+        np.array([ads_per_party[p].totals(data_type, ["total"])[0] for p in PARTIES]),
+        DATA_TYPE_PRECISIONS[data_type],
+    )
+
+
+@timer("general-aggregation")
+def create_general_data(
+    ads: AdColumns, daily_aggregates: Optional[DailyAggregateStore] = None
+) -> dict:
+    """
+    Aggregate the data shown on the index page.
+
+    :param ads: The ads of all parties.
+    :param daily_aggregates: If given, the daily series are read from this store.
+    :return: A dict that is passed to index.html as general_data.
+    """
+    ads_per_party = {p: ads.for_party(p) for p in PARTIES}
+
+    most_expensive_ad_i = ads.amounts("spending", per_day=True).argmax()
+
+    general_data = {
+        "number-of-ads-total": len(ads),
+        "number-of-ads-party": [len(ads_per_party[p]) for p in PARTIES],
+        "spending-total-lower": int(ads.spending_lower.sum()),
+        "spending-total-upper": int(ads.spending_upper.sum()),
+        "spending-party": _party_totals(ads_per_party, "spending"),
+        "impressions-party": _party_totals(ads_per_party, "impressions"),
+        "most-expensive-ad": {
+            "id": ads.ad_ids[most_expensive_ad_i],
+            "party": ads.parties[most_expensive_ad_i],
+            "spend-per-day": round(
+                ads.amounts("spending", per_day=True)[most_expensive_ad_i].item(),
+                DATA_TYPE_PRECISIONS["spending"],
+            ),
+            "days": ads.days_active[most_expensive_ad_i].item(),
+        },
+    }
+
+    for data_type in DATA_TYPES:
+        if daily_aggregates is not None:
+            general_data[f"{data_type}-party-daily"] = np.concatenate(
+                [daily_aggregates.daily(p, data_type, ["total"]) for p in PARTIES]
+            )
+        else:
+            general_data[f"{data_type}-party-daily"] = np.concatenate(
+                [ads_per_party[p].daily(data_type, ["total"]) for p in PARTIES]
+            )
+
+    return general_data
+
+
+@timer("party-aggregation")
+def create_party_data(
+    party: str,
+    party_ads: AdColumns,
+    daily_aggregates: Optional[DailyAggregateStore] = None,
+) -> dict:
+    """
+    Aggregate the data shown on a party page.
+
+    :param party: The party.
+    :param party_ads: The ads of the party.
+    :param daily_aggregates: If given, the daily series are read from this store.
+    :return: A dict that is passed to party.html as party_data.
+    """
+    party_data = {
+        "total-ads": len(party_ads),
+        "spending-total-lower": int(party_ads.spending_lower.sum()),
+        "spending-total-upper": int(party_ads.spending_upper.sum()),
+    }
+
+    for data_type in DATA_TYPES:
+        for demographic_type in DEMOGRAPHIC_TYPES:
+            demographic_list = DEMOGRAPHIC_TYPE_TO_LIST_MAP[demographic_type]
+
+            party_data[f"{data_type}-{demographic_type}"] = round_values(
+                party_ads.totals(data_type, demographic_list),
+                DATA_TYPE_PRECISIONS[data_type],
+            )
+            if daily_aggregates is not None:
+                party_data[
+                    f"{data_type}-{demographic_type}-daily"
+                ] = daily_aggregates.daily(party, data_type, demographic_list)
+            else:
+                party_data[f"{data_type}-{demographic_type}-daily"] = party_ads.daily(
+                    data_type, demographic_list
+                )
+
+    return party_data
+
+
+@timer("theme-aggregation")
+def create_theme_data(ads: AdColumns) -> dict:
+    """
+    Aggregate the data shown on the themes page.
+
+    The impressions of all themes, and of all themes per party, are computed
+    in one pass, see AdColumns.theme_totals.
+
+    :param ads: The ads of all parties.
+    :return: A dict that is passed to themes.html as theme_data.
+    """
+    themes = Theme.all()
+    precision = DATA_TYPE_PRECISIONS["impressions"]
+    theme_totals, party_counts, party_totals = ads.theme_totals(
+        "impressions", [t.value for t in themes], PARTIES
+    )
+
+    def demographic_totals(totals: np.ndarray) -> dict:
+        return {
+            demographic_type: round_values(
+                totals[
+                    [
+                        DEMOGRAPHICS.index(d)
+                        for d in DEMOGRAPHIC_TYPE_TO_LIST_MAP[demographic_type]
+                    ]
+                ],
+                precision,
+            )
+            for demographic_type in DEMOGRAPHIC_TYPES
+        }
+
+    party_codes = ads.party_codes(PARTIES)
+    matched = np.bincount(
+        party_codes[party_codes >= 0] * 2 + (ads.themes[party_codes >= 0] == 0),
+        minlength=2 * len(PARTIES),
+    ).reshape(len(PARTIES), 2)
+
+    return {
+        "impressions-demographics-theme": {
+            t.title: demographic_totals(theme_totals[theme_i])
+            for theme_i, t in enumerate(themes)
+        },
+        "impressions-demographics-theme-party": {
+            p: {
+                t.title: demographic_totals(party_totals[party_i, theme_i])
+                for theme_i, t in enumerate(themes)
+            }
+            for party_i, p in enumerate(PARTIES)
+        },
+        "impressions-theme-party": {
+            p: round_values(
+                party_totals[party_i, :, DEMOGRAPHICS.index("total")], precision
+            )
+            for party_i, p in enumerate(PARTIES)
+        },
+        "number-of-ads-theme-party": {
+            p: party_counts[party_i].tolist() for party_i, p in enumerate(PARTIES)
+        },
+        # The number of ads with and without themes.
+        "matched": {p: matched[party_i].tolist() for party_i, p in enumerate(PARTIES)},
+    }
+
+
+def render_general_pages(general_data: dict) -> List[str]:
+    """Render the index and about pages, and return the paths of the files that changed."""
+    logging.debug("Writing index.html.")
+    changed_paths = write_chart_data("index", general_data, GENERAL_DAILY_SCHEMA)
+    changed_paths.append(
+        render_template("index.html", "index.html", general_data=general_data)
+    )
+
+    logging.debug("Writing about.html.")
+    changed_paths.append(render_template("about.html", "about.html"))
+    return [path for path in changed_paths if path is not None]
+
+
+def render_party_page(party: str, party_data: dict) -> List[str]:
+    """Render the page of a party, and return the paths of the files that changed."""
+    logging.debug(f"Writing template for { party }.")
+    changed_paths = write_chart_data(party.lower(), party_data, PARTY_DAILY_SCHEMA)
+    changed_paths.append(
+        render_template(
+            "party.html",
+            f"{party.lower()}.html",
+            party=party,
+            party_data=party_data,
+            PARTY_PAGE_DATA_TYPES=PARTY_PAGE_DATA_TYPES,
+        )
+    )
+    return [path for path in changed_paths if path is not None]
+
+
+def _render_worker_party_page(party: str, incremental: bool) -> Tuple[int, List[str]]:
+    # A worker only loads the ads of its party, with its own read-only connection.
+    party_ads = _query_ads(party)
+    changed_paths = render_party_page(
+        party,
+        create_party_data(
+            party, party_ads, _worker_daily_aggregates() if incremental else None
+        ),
+    )
+    return len(party_ads), changed_paths
+
+
+@timer("party-pages")
+def render_party_pages(
+    ads: AdColumns,
+    daily_aggregates: Optional[DailyAggregateStore] = None,
+    jobs: int = 1,
+) -> List[str]:
+    """
+    Aggregate and render the pages of all parties.
+
+    :param ads: The ads of all parties.
+    :param daily_aggregates: If given, the daily series are read from this store.
+    :param jobs: The number of processes that render pages. With more than one job,
+    every process loads the ads of a party (and the saved daily aggregates) with its own read-only connection.
+    :return: The paths of the files that changed.
+    """
+    changed_paths = []
+
+    if jobs == 1:
+        for party in PARTIES:
+            party_ads = ads.for_party(party)
+            logging.info(f"Processing {len(party_ads)} ads for {party}.")
+
+            changed_paths += render_party_page(
+                party, create_party_data(party, party_ads, daily_aggregates)
+            )
+        return changed_paths
+
+    with _create_worker_pool(jobs) as executor:
+        results = executor.map(
+            _render_worker_party_page,
+            PARTIES,
+            repeat(daily_aggregates is not None),
+        )
+        for party, (number_of_ads, party_changed_paths) in zip(PARTIES, results):
+            logging.info(f"Processed {number_of_ads} ads for {party}.")
+            changed_paths += party_changed_paths
+
+    return changed_paths
+
+
+def render_themes_page(theme_data: dict) -> List[str]:
+    """Render the themes page, and return the paths of the files that changed."""
+    logging.debug("Writing themes.html.")
+    changed_path = render_template(
+        "themes.html", "themes.html", theme_data=theme_data, THEMES=Theme.titles()
+    )
+    return [changed_path] if changed_path is not None else []
@@ -0,0 +1,90 @@
+from functools import cache
+from typing import TYPE_CHECKING, List, Sequence
+
+import numpy as np
+
+from constants import NLP_MODEL
+from parsing import nlp
+from themes import Theme
+
+if TYPE_CHECKING:
+    from spacy.vectors import Vectors
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale the rows of a matrix to unit length, rows of zeros are kept."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+class ThemeCentroids:
+    """
+    The centroid of the word vectors of the wordlist of every theme.
+
+    Ads are scored by the cosine similarity between every centroid and the sum
+    of the (normalized) vectors of their lemmas. Words without a vector are ignored.
+    """
+
+    def __init__(self, themes: List[Theme], vectors: "Vectors"):
+        """
+        Compute the centroids of themes.
+
+        :param themes: The themes to score.
+        :param vectors: The word vectors, e.g. those of the spaCy model.
+        """
+        self.themes = themes
+        self.vectors = vectors
+        self.values = np.array([t.value for t in themes], dtype=np.int64)
+
+        self.matrix = np.zeros((len(themes), vectors.shape[1]), dtype=np.float32)
+        for i, theme in enumerate(themes):
+            rows = vectors.find(keys=theme.wordlist)
+            rows = rows[rows >= 0]
+            if len(rows):
+                self.matrix[i] = _normalize(vectors.data[rows]).mean(axis=0)
+
+        self.matrix = _normalize(self.matrix)
+
+    def scores(
+        self, lemmas: Sequence[str], occurrences: np.ndarray, ad_starts: np.ndarray
+    ) -> np.ndarray:
+        """
+        Return the cosine similarity between ads and every theme as an (ads x themes) array.
+
+        :param lemmas: The distinct lemmas of every ad, grouped by ad.
+        :param occurrences: The number of times every lemma occurs in its ad.
+        :param ad_starts: The index in lemmas of the first lemma of every ad.
+        """
+        # Ads share most of their lemmas, so every distinct lemma is looked up and normalized once.
+        indices = {}
+        inverse = np.fromiter(
+            (indices.setdefault(lemma, len(indices)) for lemma in lemmas),
+            dtype=np.intp,
+            count=len(lemmas),
+        )
+        rows = self.vectors.find(keys=list(indices))
+        unit_vectors = _normalize(self.vectors.data[rows]) * (rows >= 0)[:, np.newaxis]
+
+        lemma_vectors = unit_vectors[inverse]
+        lemma_vectors *= occurrences[:, np.newaxis]
+        ad_vectors = _normalize(np.add.reduceat(lemma_vectors, ad_starts, axis=0))
+        return ad_vectors @ self.matrix.T
+
+    def flags(self, scores: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+        """
+        Return the flags of the themes of ads whose similarity reaches a threshold.
+
+        :param scores: The similarities, see ThemeCentroids.scores.
+        :param thresholds: The minimum similarity of every theme.
+        """
+        return (scores >= thresholds) @ self.values
+
+
+@cache
+def theme_centroids() -> ThemeCentroids:
+    """Return the (cached) centroids of all themes, from the vectors of the spaCy model."""
+    vectors = nlp().vocab.vectors
+    if not vectors.size:
+        raise ValueError(f"The spaCy model {NLP_MODEL} does not have word vectors.")
+
+    return ThemeCentroids(Theme.all(), vectors)
@@ -1,4 +1,7 @@
-from functools import cached_property
+import hashlib
+from collections import Counter
+from functools import cache, cached_property
+from typing import Dict, Iterable, List
 
 from enum import Flag, auto
 
@@ -57,8 +60,54 @@ class Theme(Flag):
     @classmethod
     def intersections(cls, words):
         """Calculate the amount of common words between a given list and every theme."""
-        return {
-            t: sum(1 for word in words if word in t.wordlist)
-            for t in cls
-            if t != Theme.NONE
+        return theme_matcher().intersections(words)
+
+
+class ThemeMatcher:
+    """
+    Inverted index from words to the themes whose wordlist contains them.
+
+    The index counts the common words between a list of words and every theme
+    in a single pass over the words.
+    """
+
+    def __init__(self, themes: List[Theme]):
+        """
+        Build the index from the wordlists of themes.
+
+        :param themes: The themes to match.
+        """
+        self.themes = themes
+
+        # Changes whenever a theme or a wordlist changes.
+        self.version = hashlib.sha256(
+            "\n".join(
+                f"{theme.name}:{','.join(theme.wordlist)}" for theme in themes
+            ).encode()
+        ).hexdigest()
+
+        word_flags = {}
+        for theme in themes:
+            for word in theme.wordlist:
+                word_flags[word] = word_flags.get(word, Theme.NONE.value) | theme.value
+
+        # Map every word to the indices of its themes, so counting is a lookup per word.
+        self.index = {
+            word: tuple(i for i, t in enumerate(themes) if flags & t.value)
+            for word, flags in word_flags.items()
         }
+
+    def intersections(self, words: Iterable[str]) -> Dict[Theme, int]:
+        """Calculate the amount of common words between a given list and every theme."""
+        counts = [0] * len(self.themes)
+        for word, count in Counter(words).items():
+            for theme_i in self.index.get(word, ()):
+                counts[theme_i] += count
+
+        return dict(zip(self.themes, counts))
+
+
+@cache
+def theme_matcher() -> ThemeMatcher:
+    """Return the (cached) matcher of all themes."""
+    return ThemeMatcher(Theme.all())
@@ -1,63 +1,215 @@
+import gzip
+import hashlib
+import json
+import os
 from datetime import datetime, date
-from typing import Optional, Union
+from functools import cache
+from typing import Dict, List, Optional
 
+import numpy as np
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 from constants import (
+    CHANGED_FILES_PATH,
+    CHART_DATA_PATH,
     DATA_TYPES,
     DEMOGRAPHIC_TYPE_TO_LIST_MAP,
     DEMOGRAPHIC_TYPES,
     PARTIES,
 )
+from metrics import count, timer
 
-JINJA_ENVIRONMENT = Environment(
-    loader=FileSystemLoader("../templates"), autoescape=select_autoescape()
-)
+# Rendered pages end with the hash of their template sources and data.
+RENDER_HASH_COMMENT = "\n<!-- render-hash: {} -->\n"
+
+
+@cache
+def jinja_environment() -> Environment:
+    """Return the (cached) Jinja environment, which is only created when it is first used."""
+    return Environment(
+        loader=FileSystemLoader("../templates"), autoescape=select_autoescape()
+    )
 
 
-def recursive_round(o: Union[dict, list], precision: Optional[int] = None) -> None:
+def round_values(values: np.ndarray, precision: Optional[int] = None) -> list:
     """
-    Traverses an object recursively and rounds numbers found in lists.
+    Round an array of values and convert it to a list that can be rendered.
 
-    :param o: Object to round recursively.
-    :param precision: Precision to use when rounding
+    :param values: The values.
+    :param precision: The number of decimals, see DATA_TYPE_PRECISIONS. None rounds to ints.
     """
-    if isinstance(o, dict):
-        for key in o:
-            recursive_round(o[key], 2 if "spend" in key else precision)
-    elif isinstance(o, list) and len(o) > 0 and isinstance(o[0], (list, dict)):
-        for object_element in o:
-            recursive_round(object_element, precision)
-    elif isinstance(o, list) and len(o) > 0 and isinstance(o[0], (int, float)):
-        for object_index, object_element in enumerate(o):
-            o[object_index] = round(object_element, precision)
-
-
-def render_template(template: str, destination: str, **kwargs) -> None:
+    if precision is None:
+        return np.rint(values).astype(np.int64).tolist()
+    return np.round(values, precision).tolist()
+
+
+@cache
+def _templates_hash() -> str:
+    """Return the (cached) hash of all template sources, including the templates they extend."""
+    templates_hash = hashlib.sha256()
+    for template in sorted(jinja_environment().list_templates()):
+        source, _, _ = jinja_environment().loader.get_source(
+            jinja_environment(), template
+        )
+        templates_hash.update(template.encode())
+        templates_hash.update(source.encode())
+    return templates_hash.hexdigest()
+
+
+def _hashable(o) -> str:
+    """Stand in for objects that json cannot encode, e.g. the daily series."""
+    if isinstance(o, np.ndarray):
+        return f"{o.dtype}{o.shape}" + hashlib.sha256(o.tobytes()).hexdigest()
+    return str(o)
+
+
+def _render_hash(template: str, context: dict) -> str:
+    """Return the hash of a template and the variables it is rendered with."""
+    render_hash = hashlib.sha256()
+    render_hash.update(_templates_hash().encode())
+    render_hash.update(template.encode())
+    render_hash.update(json.dumps(context, sort_keys=True, default=_hashable).encode())
+    return render_hash.hexdigest()
+
+
+def write_atomically(path: str, content: bytes) -> None:
+    """
+    Write a file by renaming a temporary file over it.
+
+    Readers (and publishing) never see a partially written file.
+
+    :param path: The path of the file.
+    :param content: The new content of the file.
     """
-    Render a template.
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as h_destination:
+        h_destination.write(content)
+    os.replace(temporary_path, path)
+
+
+def write_if_changed(path: str, content: bytes) -> bool:
+    """
+    Write a file atomically, unless it already has this content.
+
+    :param path: The path of the file.
+    :param content: The new content of the file.
+    :return: Whether the file was written.
+    """
+    if os.path.exists(path):
+        with open(path, "rb") as h_destination:
+            if h_destination.read() == content:
+                return False
+
+    write_atomically(path, content)
+    return True
+
+
+def render_template(template: str, destination: str, **kwargs) -> Optional[str]:
+    """
+    Render a template, unless neither the templates nor the variables changed.
+
+    The hash of the templates and variables is stored at the end of the rendered
+    file. If the destination already ends with the same hash, the template is not
+    rendered and the file (with its last updated time) is left alone.
 
     :param template: The filename of the template.
     :param destination: The filename of the rendered file.
     :param kwargs: Any variables that should be passed to the template.
-    :return:
+    :return: The path of the rendered file if it changed, None otherwise.
     """
-    rendered_content = JINJA_ENVIRONMENT.get_template(template).render(
-        last_updated=datetime.now().strftime("%H:%M %d-%m-%Y"),
+    if template == "index.html":
+        destination_path = f"../{ destination }"
+    else:
+        destination_path = f"../website/{ destination }"
+
+    context = dict(
         PARTIES=PARTIES,
         DATA_TYPES=DATA_TYPES,
         DEMOGRAPHIC_TYPES=DEMOGRAPHIC_TYPES,
         DEMOGRAPHIC_TYPE_TO_LIST_MAP=DEMOGRAPHIC_TYPE_TO_LIST_MAP,
         **kwargs,
     )
+    hash_comment = RENDER_HASH_COMMENT.format(_render_hash(template, context))
 
-    if template == "index.html":
-        destination_path = f"../{ destination }"
-    else:
-        destination_path = f"../website/{ destination }"
+    if os.path.exists(destination_path):
+        with open(destination_path, "rb") as h_destination:
+            h_destination.seek(max(os.path.getsize(destination_path) - 256, 0))
+            if h_destination.read().endswith(hash_comment.encode()):
+                count("pages-unchanged")
+                return None
+
+    with timer("template-rendering"):
+        rendered_content = (
+            jinja_environment()
+            .get_template(template)
+            .render(last_updated=datetime.now().strftime("%H:%M %d-%m-%Y"), **context)
+        )
+
+    write_atomically(destination_path, (rendered_content + hash_comment).encode())
+    count("pages-written")
+    return destination_path
+
+
+def encode_series(series: np.ndarray, precision: Optional[int] = None) -> dict:
+    """
+    Encode daily series compactly, as the differences between consecutive values.
+
+    The values are rounded to a precision and scaled to integers, so the series
+    are decoded exactly by dividing the cumulative sums by the scale (see charts.js).
+    Rounding happens here, on the whole array at once.
+
+    :param series: A (series x dates) array.
+    :param precision: The number of decimals that the values are rounded to.
+    :return: A dict with the scale and the differences of every series.
+    """
+    scale = 10 ** (precision or 0)
+    scaled_values = np.rint(np.asarray(series) * scale).astype(np.int64)
+    deltas = np.diff(scaled_values, axis=1, prepend=0)
+
+    return {"scale": scale, "deltas": deltas.tolist()}
 
-    with open(destination_path, "w") as h_destination:
-        h_destination.write(rendered_content)
+
+@timer("chart-data")
+def write_chart_data(
+    name: str, data: dict, schema: Dict[str, Optional[int]]
+) -> List[str]:
+    """
+    Write the daily series in the data of a page to a file that the line charts load.
+
+    A gzipped copy is written next to it, for servers that serve precompressed files.
+
+    :param name: The name of the data file, e.g. the name of the page.
+    :param data: The data of a page.
+    :param schema: The keys of the series in data that are written, and the precision of each series.
+    :return: The paths of the files that changed.
+    """
+    chart_data = {
+        key: encode_series(data[key], precision) for key, precision in schema.items()
+    }
+    content = json.dumps(chart_data, separators=(",", ":")).encode()
+
+    os.makedirs(CHART_DATA_PATH, exist_ok=True)
+    path = os.path.join(CHART_DATA_PATH, f"{name}.json")
+    if not write_if_changed(path, content):
+        return []
+
+    # A fixed mtime keeps the compressed file the same for the same data.
+    write_atomically(f"{path}.gz", gzip.compress(content, compresslevel=9, mtime=0))
+    return [path, f"{path}.gz"]
+
+
+def write_manifest(changed_paths: List[str]) -> None:
+    """
+    Write the paths of the files that a build changed, relative to the root of the repo.
+
+    Publishing can ship only these files, e.g. with rsync --files-from.
+
+    :param changed_paths: The paths of the changed files, relative to the parsing directory.
+    """
+    manifest = "".join(
+        f"{os.path.relpath(path, '..')}\n" for path in sorted(changed_paths)
+    )
+    write_atomically(CHANGED_FILES_PATH, manifest.encode())
 
 
 def time_range_len(start_date: date, end_date: date) -> int:
@@ -0,0 +1,173 @@
+import json
+import os
+import sys
+import threading
+from collections import defaultdict
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import pytest
+
+PARSING_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "parsing"
+)
+sys.path.insert(0, PARSING_PATH)
+
+from constants import DATABASE_PRAGMAS, DATABASE_TIMEOUT_SECONDS  # noqa: E402
+from models import MODELS, database_handler  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def parsing_directory(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Run tests in the parsing directory, which the relative paths in the code start from."""
+    monkeypatch.chdir(PARSING_PATH)
+
+
+@pytest.fixture
+def archive(tmp_path) -> database_handler:
+    """Point the models to an empty archive in a temporary directory."""
+    database_handler.init(
+        str(tmp_path / "archive.sqlite"),
+        pragmas=DATABASE_PRAGMAS,
+        timeout=DATABASE_TIMEOUT_SECONDS,
+    )
+    database_handler.create_tables(MODELS)
+    yield database_handler
+    database_handler.close()
+
+
+@pytest.fixture
+def memory_archive() -> database_handler:
+    """Point the models to an empty archive in memory."""
+    database_handler.init(":memory:", pragmas=DATABASE_PRAGMAS)
+    database_handler.create_tables(MODELS)
+    yield database_handler
+    database_handler.close()
+
+
+@pytest.fixture
+def make_ad() -> Callable[..., dict]:
+    """Return a function that creates a dict that corresponds with the Ad model."""
+
+    def make_ad(
+        ad_id: str,
+        start_date: date,
+        end_date: Optional[date],
+        party: str = "VVD",
+        spending_lower: int = 100,
+        **fields,
+    ) -> dict:
+        return {
+            "ad_id": ad_id,
+            "page_id": "1",
+            "party": party,
+            "themes": 0,
+            "creation_date": start_date,
+            "start_date": start_date,
+            "end_date": end_date,
+            "creative_bodies": "",
+            "creative_link_captions": "",
+            "creative_link_descriptions": "",
+            "creative_link_titles": "",
+            "spending_lower": spending_lower,
+            "spending_upper": spending_lower + 99,
+            "impressions_lower": 1000,
+            "impressions_upper": 1999,
+            "audience_size_lower": 1000,
+            "audience_size_upper": 2000,
+            "demographics": None,
+        } | fields
+
+    return make_ad
+
+
+@pytest.fixture
+def make_api_ad() -> Callable[..., dict]:
+    """Return a function that creates an ad with demographics in the format of the Facebook Ad Library API."""
+
+    def make_api_ad(ad_id: str, **fields) -> dict:
+        return {
+            "id": ad_id,
+            "page_id": "1",
+            "ad_creation_time": "2022-02-28",
+            "ad_delivery_start_time": "2022-03-01",
+            "ad_delivery_stop_time": "2022-03-10",
+            "ad_creative_bodies": ["Stem op ons"],
+            "currency": "EUR",
+            "languages": ["nl"],
+            "spend": {"lower_bound": "100", "upper_bound": "199"},
+            "impressions": {"lower_bound": "1000", "upper_bound": "1999"},
+            "estimated_audience_size": {"lower_bound": 1000, "upper_bound": 2000},
+            "delivery_by_region": [
+                {"region": "Utrecht", "percentage": "0.25"},
+                {"region": "North Brabant", "percentage": "0.7"},
+                {"region": "Unknown", "percentage": "0.05"},
+            ],
+            "demographic_distribution": [
+                {"gender": "female", "age": "18-24", "percentage": "0.1"},
+                {"gender": "female", "age": "65+", "percentage": "0.3"},
+                {"gender": "male", "age": "18-24", "percentage": "0.2"},
+                {"gender": "unknown", "age": "65+", "percentage": "0.4"},
+            ],
+        } | fields
+
+    return make_api_ad
+
+
+class StandInAPI:
+    """
+    A local HTTP server that stands in for the Facebook Ad Library API.
+
+    It serves canned responses per path, in the order they were added, and
+    records the path of every request.
+    """
+
+    def __init__(self):
+        """Start the server on a free port."""
+        self.responses = defaultdict(list)
+        self.requests: List[str] = []
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                path = urlsplit(self.path).path
+                stand_in.requests.append(path)
+                status, body = stand_in.responses[path].pop(0)
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path: str) -> str:
+        """Return the url of a path on the server."""
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def add(self, path: str, response: Union[dict, str], status: int = 200) -> None:
+        """Add a response to the responses of a path, a dict is served as JSON."""
+        body = json.dumps(response) if isinstance(response, dict) else response
+        self.responses[path].append((status, body.encode()))
+
+    def close(self) -> None:
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def api_server() -> Iterator[StandInAPI]:
+    """Start a stand-in of the Facebook Ad Library API."""
+    stand_in = StandInAPI()
+    yield stand_in
+    stand_in.close()
@@ -0,0 +1,57 @@
+import os
+from datetime import date
+
+import numpy as np
+
+from aggregates import DailyAggregateStore
+from models import Ad, DirtyAd
+
+FIRST_DATE = date(2022, 3, 1)
+AS_OF = date(2022, 3, 31)
+TODAY = date(2022, 4, 14)
+
+
+def test_refresh_matches_build(archive, make_ad):
+    """A refreshed store has the same series as a store that is built from scratch."""
+    Ad.insert_many(
+        [
+            make_ad("ended", date(2022, 3, 1), date(2022, 3, 10)),
+            make_ad("ends-on-as-of", date(2022, 3, 1), AS_OF, party="D66"),
+            make_ad("ends-after-as-of", date(2022, 3, 20), date(2022, 4, 10)),
+            make_ad("starts-after-as-of", date(2022, 4, 5), date(2022, 4, 12)),
+            make_ad("active", date(2022, 3, 25), None, party="D66"),
+        ]
+    ).execute()
+    store, _ = DailyAggregateStore.build(FIRST_DATE, AS_OF)
+
+    Ad.insert_many(
+        [
+            make_ad("ended", date(2022, 3, 1), date(2022, 3, 10), spending_lower=1000),
+            make_ad("new", date(2022, 4, 1), date(2022, 4, 2), party="SP"),
+        ]
+    ).on_conflict_replace().execute()
+    DirtyAd.mark(["ended", "new"])
+
+    store.refresh(TODAY)
+    fresh_store, _ = DailyAggregateStore.build(FIRST_DATE, TODAY)
+
+    assert sorted(store.ads.ad_ids) == sorted(fresh_store.ads.ad_ids)
+    np.testing.assert_array_equal(store.counts, fresh_store.counts)
+    np.testing.assert_allclose(store.sums, fresh_store.sums)
+
+
+def test_dirty_ads_are_cleared_after_saving(archive, make_ad, tmp_path):
+    """Refreshing does not unmark ads, only the marks up to the refreshed ones are removed after saving."""
+    Ad.insert_many([make_ad("1", date(2022, 3, 1), date(2022, 3, 10))]).execute()
+    DirtyAd.mark(["1"])
+    store, last_dirty_id = DailyAggregateStore.build(FIRST_DATE, AS_OF)
+    assert DirtyAd.select().count() == 1
+
+    DirtyAd.mark(["2"])
+    path = str(tmp_path / "daily_aggregates.npz")
+    store.save(path)
+    DirtyAd.clear(last_dirty_id)
+
+    assert [ad_id for ad_id, in DirtyAd.select(DirtyAd.ad_id).tuples()] == ["2"]
+    assert DailyAggregateStore.load(path).ads.ad_ids.tolist() == ["1"]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
@@ -0,0 +1,84 @@
+from datetime import date
+
+import numpy as np
+import pytest
+from spacy.vectors import Vectors
+
+import classify
+from classify import classify_ads, classify_ads_by_similarity, content_hash
+from constants import UNCLASSIFIED_THEMES
+from models import Ad, AdLemma, AdTheme, ThemeCache
+from parsing import ad_content
+from similarity import ThemeCentroids
+from themes import Theme, theme_matcher
+
+
+def theme_centroids() -> ThemeCentroids:
+    """Return the centroids of themes whose words have their own dimension."""
+    themes = Theme.all()[:2]
+    words = [theme.wordlist[0] for theme in themes]
+    return ThemeCentroids(
+        themes, Vectors(data=np.eye(len(words), dtype=np.float32), keys=words)
+    )
+
+
+def test_ads_without_lemmas_have_no_theme(memory_archive, make_ad):
+    """Ads without lemmas lose their themes, also when no ad of a batch has lemmas."""
+    first, second = Theme.all()[:2]
+    Ad.insert_many(
+        [
+            make_ad(str(i), date(2022, 3, 1), None, themes=first.value | second.value)
+            for i in range(3)
+        ]
+    ).execute()
+    AdTheme.set_themes({str(i): first.value | second.value for i in range(3)})
+    AdLemma.set_lemmas({"0": [second.wordlist[0]] * 2})
+
+    centroids = theme_centroids()
+    n_changed = classify_ads_by_similarity(
+        centroids, np.full(len(centroids.themes), 0.5, dtype=np.float32), batch_size=1
+    )
+
+    assert n_changed == 3
+    assert dict(Ad.select(Ad.ad_id, Ad.themes).tuples()) == {
+        "0": second.value,
+        "1": Theme.NONE.value,
+        "2": Theme.NONE.value,
+    }
+    assert set(AdTheme.select(AdTheme.ad_id, AdTheme.theme).tuples()) == {
+        ("0", second.value)
+    }
+
+
+def test_cached_ads_are_not_parsed(memory_archive, make_ad, monkeypatch):
+    """Ads whose texts are all cached are classified without loading the spaCy model."""
+    monkeypatch.setattr(classify, "model_version", lambda: "model-1.0")
+    monkeypatch.setattr(classify, "nlp", lambda: pytest.fail("The model was loaded."))
+
+    theme = Theme.all()[0]
+    ads = [
+        make_ad(
+            str(i),
+            date(2022, 3, 1),
+            None,
+            themes=UNCLASSIFIED_THEMES,
+            creative_bodies="Stem",
+        )
+        for i in range(2)
+    ]
+    Ad.insert_many(ads).execute()
+    ThemeCache.create(
+        content_hash=content_hash(ad_content(ads[0]), "model-1.0"),
+        model_version="model-1.0",
+        lemmas=f'["{theme.wordlist[0]}"]',
+        themes=theme.value,
+        wordlist_version=theme_matcher().version,
+    )
+
+    classify_ads(batch_size=1, n_process=2)
+
+    assert dict(Ad.select(Ad.ad_id, Ad.themes).tuples()) == {
+        "0": theme.value,
+        "1": theme.value,
+    }
+    assert AdLemma.lemmas(["0"]) == {"0": [theme.wordlist[0]]}
@@ -0,0 +1,62 @@
+import json
+import os
+from datetime import date
+
+import numpy as np
+import pytest
+
+from aggregation import AdColumns
+from cube import Cube
+from models import Ad
+
+FIRST_DATE = date(2022, 1, 1)
+LAST_DATE = date(2022, 12, 31)
+
+
+@pytest.fixture
+def ads(memory_archive, make_ad) -> AdColumns:
+    """Return ads that were active in March 2022, one of them is still active."""
+    Ad.insert_many(
+        [
+            make_ad("1", date(2022, 3, 1), date(2022, 3, 10)),
+            make_ad("2", date(2022, 3, 5), date(2022, 3, 20), party="D66"),
+            make_ad("3", date(2022, 3, 15), None, spending_lower=500),
+        ]
+    ).execute()
+    return AdColumns.from_query(
+        Ad.select(), FIRST_DATE, LAST_DATE, today=date(2022, 3, 31)
+    )
+
+
+def test_cube_spans_the_dates_of_the_ads(tmp_path, ads):
+    """The date axis of the cube starts when the first ad started, and ends when the last ad ended."""
+    cube = Cube.build(ads, str(tmp_path / "cube.json"))
+
+    assert cube.first_date == date(2022, 3, 1)
+    assert cube.last_date == date(2022, 3, 31)
+    assert cube.range_sum("spending") == pytest.approx(
+        ads.daily("spending", ["total"]).sum()
+    )
+    assert cube.range_sum("spending", party="D66") == pytest.approx(
+        ads.for_party("D66").daily("spending", ["total"]).sum()
+    )
+    assert cube.range_sum(
+        "spending", first_date=date(2022, 1, 1), last_date=date(2022, 2, 28)
+    ) == pytest.approx(0)
+
+
+def test_rebuilding_a_cube_replaces_its_array(tmp_path, ads):
+    """A cube file points to a new array when it is rebuilt, and the old array is removed."""
+    path = str(tmp_path / "cube.json")
+    old_cube = Cube.build(ads, path)
+    old_total = old_cube.range_sum("spending")
+
+    new_cube = Cube.build(ads.for_party("D66"), path)
+
+    with open(path) as h_cube:
+        array_name = json.load(h_cube)["values"]
+    assert sorted(os.listdir(tmp_path)) == sorted(["cube.json", array_name])
+    assert np.asarray(Cube.load(path).values).tolist() == new_cube.values.tolist()
+
+    # The memory-mapped array of the old cube can still be read.
+    assert old_cube.range_sum("spending") == old_total
@@ -0,0 +1,58 @@
+import pytest
+
+import download
+from download import create_session, download_ads
+from models import Ad
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Retry failed requests without waiting."""
+    monkeypatch.setattr(download, "RETRY_BACKOFF_SECONDS", 0)
+
+
+def downloaded_ad_ids() -> list:
+    """Return the ids of the ads in the archive."""
+    return sorted(ad_id for ad_id, in Ad.select(Ad.ad_id).tuples())
+
+
+def test_download_follows_pages_and_retries_rate_limits(
+    archive, api_server, make_api_ad
+):
+    """All pages are downloaded, and a rate limited page is requested again."""
+    api_server.add("/ads", {"error": {"code": 613, "message": "Calls limited"}})
+    api_server.add(
+        "/ads",
+        {
+            "data": [make_api_ad("1"), make_api_ad("2")],
+            "paging": {"next": api_server.url("/ads/2")},
+        },
+    )
+    api_server.add("/ads/2", {"data": [make_api_ad("3")], "paging": {}})
+
+    download_ads(create_session(1), api_server.url("/ads"), "VVD")
+
+    assert api_server.requests == ["/ads", "/ads", "/ads/2"]
+    assert downloaded_ad_ids() == ["1", "2", "3"]
+    assert {party for party, in Ad.select(Ad.party).tuples()} == {"VVD"}
+
+
+def test_download_retries_server_errors(archive, api_server, make_api_ad):
+    """A response that is not JSON (e.g. from a proxy) is requested again."""
+    api_server.add("/ads", "<html>Bad Gateway</html>", status=502)
+    api_server.add("/ads", {"data": [make_api_ad("1")]})
+
+    download_ads(create_session(1), api_server.url("/ads"), "VVD")
+
+    assert api_server.requests == ["/ads", "/ads"]
+    assert downloaded_ad_ids() == ["1"]
+
+
+def test_download_stops_at_errors_that_are_not_transient(archive, api_server):
+    """An error that is not transient (e.g. an invalid token) is not retried."""
+    api_server.add("/ads", {"error": {"code": 190, "message": "Invalid token"}})
+
+    download_ads(create_session(1), api_server.url("/ads"), "VVD")
+
+    assert api_server.requests == ["/ads"]
+    assert downloaded_ad_ids() == []
@@ -0,0 +1,12 @@
+from benchmark import IMPORT_TIME_MODULES, import_seconds
+
+# The budget of the cold start import of the modules every script imports.
+IMPORT_TIME_BUDGET_SECONDS = 1.5
+
+
+def test_import_time_budget():
+    """Importing IMPORT_TIME_MODULES in a new interpreter stays within IMPORT_TIME_BUDGET_SECONDS."""
+    # Modules that an earlier module imports (e.g. themes) are part of its time.
+    seconds = import_seconds()
+    assert IMPORT_TIME_MODULES[0] in seconds
+    assert sum(seconds.values()) <= IMPORT_TIME_BUDGET_SECONDS
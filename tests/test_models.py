@@ -0,0 +1,109 @@
+from datetime import date, timedelta
+
+import pytest
+
+from constants import PARTIES
+from models import Ad, AdTheme
+from themes import Theme
+
+# The ads of the time range tests start on consecutive days, and run for a week.
+TIME_RANGE_ADS = 5000
+TIME_RANGE_START = date(2010, 1, 1)
+
+
+def query_plan(database, query) -> list:
+    """Return the steps of the plan of a query."""
+    sql, params = query.sql()
+    return [
+        row[-1] for row in database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)
+    ]
+
+
+def virtual_machine_steps(database, query) -> int:
+    """Return the number of SQLite virtual machine instructions it takes to run a query, which grows with the rows it examines."""
+    steps = 0
+
+    def count_step() -> int:
+        nonlocal steps
+        steps += 1
+        return 0
+
+    database.connection().set_progress_handler(count_step, 1)
+    try:
+        list(query.tuples())
+    finally:
+        database.connection().set_progress_handler(None, 1)
+
+    return steps
+
+
+def naive_time_range(first_date: date, last_date: date):
+    """Return the ads in a time range, with the predicate of Ad.ads_in_time_range as a single OR."""
+    return Ad.select().where(
+        (Ad.start_date <= last_date)
+        & ((Ad.end_date >= first_date) | Ad.end_date.is_null())
+    )
+
+
+@pytest.fixture
+def time_range_archive(memory_archive, make_ad):
+    """Fill the archive with ads that start on consecutive days, every hundredth is still active."""
+    ads = []
+    for i in range(TIME_RANGE_ADS):
+        start_date = TIME_RANGE_START + timedelta(days=i)
+        end_date = start_date + timedelta(days=7) if i % 100 else None
+        ads.append(make_ad(str(i), start_date, end_date, party=PARTIES[i % 3]))
+
+    Ad.insert_many(ads).execute()
+    return memory_archive
+
+
+@pytest.mark.parametrize("first_day,last_day", [(0, 10), (2000, 2500), (4970, 5100)])
+def test_ads_in_time_range_matches_predicate(time_range_archive, first_day, last_day):
+    """The ads in a time range are those that start before its end and end after its start."""
+    first_date = TIME_RANGE_START + timedelta(days=first_day)
+    last_date = TIME_RANGE_START + timedelta(days=last_day)
+
+    ad_ids = {ad.ad_id for ad in Ad.ads_in_time_range(first_date, last_date)}
+    assert ad_ids == {ad.ad_id for ad in naive_time_range(first_date, last_date)}
+    assert ad_ids
+
+    party_ad_ids = {
+        ad.ad_id for ad in Ad.ads_in_time_range(first_date, last_date, PARTIES[1])
+    }
+    assert party_ad_ids == {
+        ad.ad_id
+        for ad in naive_time_range(first_date, last_date).where(Ad.party == PARTIES[1])
+    }
+    assert party_ad_ids
+
+
+def test_ads_in_time_range_examines_recent_ads(time_range_archive):
+    """A recent time range examines the ads that end in it, instead of every ad."""
+    first_date = TIME_RANGE_START + timedelta(days=TIME_RANGE_ADS - 30)
+    last_date = TIME_RANGE_START + timedelta(days=TIME_RANGE_ADS)
+
+    steps = virtual_machine_steps(
+        time_range_archive, Ad.ads_in_time_range(first_date, last_date)
+    )
+    naive_steps = virtual_machine_steps(
+        time_range_archive, naive_time_range(first_date, last_date)
+    )
+    assert steps * 10 < naive_steps
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        lambda: Ad.ads_in_time_range(first_date=date(2020, 9, 1)),
+        lambda: Ad.ads_in_time_range(first_date=date(2020, 9, 1), party="VVD"),
+        lambda: Ad.select()
+        .where(Ad.party == "VVD")
+        .where(Ad.ad_id.in_(AdTheme.ad_ids(Theme.CLIMATE.value))),
+    ],
+    ids=["time-range", "time-range-party", "theme-party"],
+)
+def test_filters_use_indexes(memory_archive, query):
+    """Time range, party and theme filters are index lookups instead of table scans."""
+    plan = query_plan(memory_archive, query())
+    assert not any(step.startswith("SCAN") for step in plan), plan
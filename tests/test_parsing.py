@@ -0,0 +1,117 @@
+import json
+from datetime import date
+from typing import Tuple
+
+import pytest
+
+from benchmark import _decimal_demographics, _strptime_dates, seconds_per_item
+from constants import DEMOGRAPHICS
+from models import Ad
+from parsing import AdStream, json_to_ad_dict
+
+
+def test_json_to_ad_dict_sums_demographics(make_api_ad):
+    """Percentages are summed per gender and age group, and unknown groups are ignored."""
+    ad_dict = json_to_ad_dict(make_api_ad("1"), "VVD")
+    fractions = Ad(demographics=ad_dict["demographics"]).demographic_fractions
+
+    expected = dict.fromkeys(DEMOGRAPHICS[1:], 0.0) | {
+        "female": 0.4,
+        "male": 0.2,
+        "18-24": 0.3,
+        "65+": 0.7,
+        "Utrecht": 0.25,
+        "Noord-Brabant": 0.7,
+    }
+    # The fractions are stored as float32.
+    assert fractions == pytest.approx(list(expected.values()), rel=1e-6)
+
+
+def test_json_to_ad_dict_parses_dates(make_api_ad):
+    """The dates of an ad are parsed, an ad that is still running has no end date."""
+    ad = make_api_ad("1")
+    ad_dict = json_to_ad_dict(ad, "VVD")
+    assert ad_dict["creation_date"] == date(2022, 2, 28)
+    assert ad_dict["start_date"] == date(2022, 3, 1)
+    assert ad_dict["end_date"] == date(2022, 3, 10)
+
+    del ad["ad_delivery_stop_time"]
+    assert json_to_ad_dict(ad, "VVD")["end_date"] is None
+
+
+def test_json_to_ad_dict_is_faster_than_decimals(make_api_ad):
+    """
+    Converting an ad takes less time than only its demographics and dates took with Decimal and strptime.
+
+    Both are timed in the same run, so the check does not depend on the speed of the machine.
+    """
+    ads = [make_api_ad(str(i)) for i in range(2000)]
+
+    seconds = seconds_per_item(lambda ad: json_to_ad_dict(ad, "VVD"), ads)
+    previous_seconds = seconds_per_item(_decimal_demographics, ads) + seconds_per_item(
+        _strptime_dates, ads
+    )
+    assert seconds < previous_seconds
+
+
+# A response with numbers, multi-byte characters and escapes in every position of the data and the other members.
+STREAM_RESPONSE = {
+    "data": [
+        {"id": "1", "spend": 12345, "text": "Stem op één partij: €100"},
+        {
+            "id": "2",
+            "spend": -2.5e3,
+            "text": '\u00e9 \\ " \U0001f5f3',
+            "nested": [1, {}],
+        },
+    ],
+    "paging": {"cursors": {"after": "QVFI"}, "next": "https://example.org/?a=1"},
+    "count": 9876543210,
+}
+STREAM_BODY = json.dumps(STREAM_RESPONSE, ensure_ascii=False).encode()
+
+
+def parse_stream(chunks: list) -> Tuple[list, AdStream]:
+    """Parse a response from chunks, and return its ads and the stream."""
+    stream = AdStream(chunks)
+    return list(stream), stream
+
+
+@pytest.mark.parametrize("split", range(1, len(STREAM_BODY)))
+def test_stream_is_split_anywhere(split):
+    """A response that is split in two chunks at any byte parses like the whole response."""
+    ads, stream = parse_stream([STREAM_BODY[:split], STREAM_BODY[split:]])
+    assert ads == STREAM_RESPONSE["data"]
+    assert stream.paging == STREAM_RESPONSE["paging"]
+
+
+def test_stream_of_single_bytes():
+    """A response that arrives one byte at a time, with empty chunks in between, parses completely."""
+    chunks = [b""] + [STREAM_BODY[i : i + 1] for i in range(len(STREAM_BODY))] + [b""]
+    ads, stream = parse_stream(chunks)
+    assert ads == STREAM_RESPONSE["data"]
+    assert stream.paging == STREAM_RESPONSE["paging"]
+
+
+@pytest.mark.parametrize("chunks", [[], [b""], [b"  "]])
+def test_stream_of_empty_body(chunks):
+    """An empty response is an error."""
+    with pytest.raises(ValueError):
+        parse_stream(chunks)
+
+
+@pytest.mark.parametrize("length", range(1, len(STREAM_BODY)))
+def test_stream_of_truncated_body(length):
+    """A response that ends early is an error, also when it ends after a complete number."""
+    with pytest.raises(ValueError):
+        parse_stream([STREAM_BODY[:length]])
+
+
+def test_stream_error_after_data():
+    """An error that follows the ads is available after iterating."""
+    error = {"code": 1, "message": "An unknown error occurred"}
+    body = json.dumps({"data": [{"id": "1"}], "error": error}).encode()
+
+    ads, stream = parse_stream([body[:20], body[20:]])
+    assert ads == [{"id": "1"}]
+    assert stream.error == error
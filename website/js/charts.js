@@ -25,6 +25,44 @@ const COLORS = [
 const FIRST_DATE = new Date(2020, 8, 1);
 const LAST_DATE = Date.now();
 
+// The promises of the chart data files that have been requested, by url.
+const CHART_DATA = {};
+
+function loadChartData(url) {
+    if (!(url in CHART_DATA)) {
+        CHART_DATA[url] = fetch(url).then(response => response.json());
+    }
+    return CHART_DATA[url];
+}
+
+// Decode series that were encoded by utils.encode_series.
+function decodeSeries(encoded) {
+    return encoded.deltas.map(function (deltas) {
+        let value = 0;
+        return deltas.map(function (delta) {
+            value += delta;
+            return value / encoded.scale;
+        });
+    });
+}
+
+// Line charts with a data file are only created when they are (almost) scrolled into view.
+const LAZY_CHART_OBSERVER = new IntersectionObserver(function (entries, observer) {
+    entries.forEach(function (entry) {
+        if (!entry.isIntersecting) {
+            return;
+        }
+
+        let canvas = entry.target;
+        observer.unobserve(canvas);
+
+        loadChartData($(canvas).data("src")).then(function (chartData) {
+            let data = decodeSeries(chartData[$(canvas).data("key")]);
+            new Chart(canvas, generateLineGraphConfig(canvas, data));
+        });
+    });
+}, {rootMargin: "200px"});
+
 function getDaysArray() {
     let dates = [];
     for (let dt = new Date(FIRST_DATE); dt <= LAST_DATE; dt.setDate(dt.getDate() + 1)) {
@@ -33,9 +71,8 @@ function getDaysArray() {
     return dates;
 }
 
-function generateLineGraphConfig(canvas) {
+function generateLineGraphConfig(canvas, data) {
 
-    let data = $(canvas).data("data");
     let labels = $(canvas).data("labels");
     let is_general_chart = labels.includes("VVD");
 
@@ -185,8 +222,10 @@ function generateBarChart(canvas) {
 $(document).ready(function () {
 
     $("canvas").each(function (index, canvas) {
-            if (canvas.id.includes("daily")) {
-                new Chart(canvas, generateLineGraphConfig(canvas));
+            if (canvas.id.includes("daily") && $(canvas).data("src")) {
+                LAZY_CHART_OBSERVER.observe(canvas);
+            } else if (canvas.id.includes("daily")) {
+                new Chart(canvas, generateLineGraphConfig(canvas, $(canvas).data("data")));
             } else {
                 new Chart(canvas, generateBarChart(canvas));
             }